@@ -8,6 +8,9 @@ export CASA_TEST="$CASA/tests"
 export PATH="$CASA/src/brainvisa-cmake/bin:$CASA/build/bin:$PATH:$CONDA_PREFIX/x86_64-conda-linux-gnu/sysroot/usr/bin"
 export CMAKE_LIBRARY_PATH="$CONDA_PREFIX/lib:$CONDA_PREFIX/x86_64-conda-linux-gnu/sysroot/usr/lib64"
 export BRAINVISA_BVMAKER_CFG="$CASA/conf/bv_maker.cfg"
+# Options given to make by bv_maker. soma_forge empties it to use its own
+# jobserver (with make >= 4.4).
+export SOMA_FORGE_MAKE_OPTIONS="-j$(nproc)"
 export LD_LIBRARY_PATH="$CASA/build/lib:$LD_LIBRARY_PATH"
 python_short=$(python -c 'import sys; print(".".join(str(i) for i in sys.version_info[0:2]))')
 export PYTHONPATH="$CASA/python:$CASA/src/brainvisa-cmake/python:$CASA/build/lib/python${python_short}/site-packages"
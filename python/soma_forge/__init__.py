@@ -1,74 +1,334 @@
+import collections
+import concurrent.futures
+import ctypes
+import errno
+import fcntl
+import gzip
+import hashlib
+import heapq
 import json
 import os
 import pathlib
+import pickle
 import re
+import select
 import shlex
+import shutil
+import struct
 import subprocess
 import sys
+import tarfile
+import tempfile
+import threading
+import time
 import toml
+import uuid
 import yaml
+import zipfile
+
+from .install import jobserver_fds
 
 pixi_root = pathlib.Path(os.environ["PIXI_PROJECT_ROOT"])
 
 
+# Use libyaml parser if available
+yaml_loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
+# YAML files parsed by read_yaml_files() are stored in this file. It
+# contains a dictionary whose keys are file names and values are
+# dictionaries with the file modification time and size ("mtime"), its
+# content hash ("hash") and the parsed content ("content").
+yaml_cache_file = pixi_root / "forge" / "cache" / "yaml.pickle"
+yaml_cache_version = 1
+
+
+def write_atomic(path, content):
+    """
+    Write bytes in a file that is replaced atomically
+    """
+    tmp = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}")
+    with open(tmp, "wb") as f:
+        f.write(content)
+    os.replace(tmp, path)
+
+
+def read_yaml_files(yaml_files, process=None):
+    """
+    Return a dictionary whose keys are the given YAML file names and values
+    are their parsed content. A file is only parsed if its modification time
+    and its content changed since the last time it was stored in
+    yaml_cache_file. If given, process(yaml_file, content) is called on
+    newly parsed content before it is stored in cache.
+    """
+    cache = None
+    try:
+        with open(yaml_cache_file, "rb") as f:
+            cache = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        pass
+    if not isinstance(cache, dict) or cache.get("version") != yaml_cache_version:
+        cache = {"version": yaml_cache_version, "files": {}}
+    cached_files = cache["files"]
+
+    modified = False
+    result = {}
+    for yaml_file in yaml_files:
+        key = str(yaml_file)
+        stat = os.stat(yaml_file)
+        mtime = (stat.st_mtime_ns, stat.st_size)
+        cached = cached_files.get(key)
+        if cached and cached["mtime"] == mtime:
+            result[key] = cached["content"]
+            continue
+        with open(yaml_file, "rb") as f:
+            content = f.read()
+        content_hash = hashlib.sha256(content).hexdigest()
+        if not cached or cached["hash"] != content_hash:
+            content = yaml.load(content, Loader=yaml_loader)
+            if process is not None:
+                process(yaml_file, content)
+            cached = {"content": content}
+        cached.update(mtime=mtime, hash=content_hash)
+        cached_files[key] = cached
+        result[key] = cached["content"]
+        modified = True
+    if modified:
+        # Forget files that do not exist anymore
+        for key in list(cached_files):
+            if not os.path.exists(key):
+                del cached_files[key]
+        yaml_cache_file.parent.mkdir(parents=True, exist_ok=True)
+        write_atomic(
+            yaml_cache_file, pickle.dumps(cache, protocol=pickle.HIGHEST_PROTOCOL)
+        )
+        # Returned content must not share data with the cache
+        result = pickle.loads(pickle.dumps(result))
+    return result
+
+
+def recipe_type(recipe):
+    """
+    Return the kind of a recipe: "brainvisa-cmake" for packages built from
+    bv_maker build directory, "virtual" for packages without build step and
+    "soma-forge" for other packages.
+    """
+    build = recipe.get("build")
+    if build:
+        script = build.get("script")
+        if isinstance(script, str) and "BRAINVISA_INSTALL_PREFIX" in script:
+            return "brainvisa-cmake"
+        else:
+            return "soma-forge"
+    return "virtual"
+
+
 def read_recipes():
     """
     Iterate over all recipes files defined in soma-forge.
     """
-    for recipe_file in (pixi_root / "recipes").glob("*/recipe.yaml"):
-        with open(recipe_file) as f:
-            recipe = yaml.safe_load(f)
-            recipe["soma-forge"] = {"recipe_dir": str(recipe_file.parent)}
-            yield recipe
 
+    def process(recipe_file, recipe):
+        recipe["soma-forge"] = {
+            "recipe_dir": str(pathlib.Path(recipe_file).parent),
+            "type": recipe_type(recipe),
+        }
 
-def selected_recipes(selection=None):
+    yield from read_yaml_files(
+        sorted((pixi_root / "recipes").glob("*/recipe.yaml")), process
+    ).values()
+
+
+def recipe_dependencies(recipe):
     """
-    Iterate over recipes selected in configuration and their dependencies.
+    Return the set of soma-forge packages that a recipe (as returned by
+    selected_recipes()) depends on.
     """
-    # Read recipes
-    recipes = {r["package"]["name"]: r for r in read_recipes()}
-
-    # Parse direct dependencies
-    no_dependency = set(recipes)
-    for package, recipe in recipes.items():
-        build = recipe.get("build")
-        if build:
-            script = build.get("script")
-            if isinstance(script, str) and "BRAINVISA_INSTALL_PREFIX" in script:
-                recipe["soma-forge"]["type"] = "brainvisa-cmake"
-            else:
-                recipe["soma-forge"]["type"] = "soma-forge"
-        else:
-            recipe["soma-forge"]["type"] = "virtual"
+    requirements = recipe["soma-forge"].get("requirements", {})
+    return requirements.get("brainvisa-cmake", set()).union(
+        requirements.get("soma-forge", set())
+    )
+
+
+class RecipeGraph:
+    """
+    Dependency graph between all soma-forge recipes. For each package,
+    dependencies gives the sorted list of soma-forge packages it depends on
+    and dependents the sorted list of packages depending on it. All
+    traversals are linear in the number of packages and dependencies.
+    """
+
+    def __init__(self, recipes):
+        self.recipes = {r["package"]["name"]: r for r in recipes}
+
+        # Parse direct dependencies
+        for package, recipe in self.recipes.items():
+            for requirement in recipe.get("requirements", {}).get("run", []):
+                if not isinstance(requirement, str) or requirement.startswith("$"):
+                    continue
+                dependency = requirement.split(None, 1)[0]
+                if dependency not in self.recipes:
+                    recipe["soma-forge"].setdefault("requirements", {}).setdefault(
+                        "conda-forge", set()
+                    ).add(dependency)
+                else:
+                    type = recipe["soma-forge"]["type"]
+                    if type == "virtual":
+                        type = "brainvisa-cmake"
+                    recipe["soma-forge"].setdefault("requirements", {}).setdefault(
+                        type, set()
+                    ).add(dependency)
+
+        self.dependencies = {
+            package: sorted(recipe_dependencies(recipe))
+            for package, recipe in sorted(self.recipes.items())
+        }
+        self.dependents = {package: [] for package in self.dependencies}
+        for package, dependencies in self.dependencies.items():
+            for dependency in dependencies:
+                self.dependents[dependency].append(package)
+        self._topological_order = None
+        self._cycles = None
+
+    def topological_order(self):
+        """
+        Return the list of all packages sorted such that each package comes
+        after the packages it depends on. Raise ValueError if there are
+        dependency cycles.
+        """
+        if self._topological_order is None:
+            counts = {p: len(d) for p, d in self.dependencies.items()}
+            order = [p for p, c in counts.items() if c == 0]
+            for package in order:
+                for dependent in self.dependents[package]:
+                    counts[dependent] -= 1
+                    if counts[dependent] == 0:
+                        order.append(dependent)
+            if len(order) != len(counts):
+                raise ValueError(
+                    "dependency cycles between packages: "
+                    + ", ".join(f"({', '.join(c)})" for c in self.cycles())
+                )
+            self._topological_order = order
+        return self._topological_order
 
-        for requirement in recipe.get("requirements").get("run", []):
-            if not isinstance(requirement, str) or requirement.startswith("$"):
+    def cycles(self):
+        """
+        Return the list of dependency cycles. Each cycle is the sorted list
+        of packages that depend on each other (a strongly connected component
+        of the graph found with Tarjan's algorithm).
+        """
+        if self._cycles is None:
+            index = {}
+            lowlink = {}
+            stack = []
+            on_stack = set()
+            cycles = []
+            for root in self.dependencies:
+                if root in index:
+                    continue
+                # Iterative depth first search, each work item is a package
+                # and an iterator on its dependencies
+                index[root] = lowlink[root] = len(index)
+                stack.append(root)
+                on_stack.add(root)
+                work = [(root, iter(self.dependencies[root]))]
+                while work:
+                    package, dependencies = work[-1]
+                    for dependency in dependencies:
+                        if dependency not in index:
+                            index[dependency] = lowlink[dependency] = len(index)
+                            stack.append(dependency)
+                            on_stack.add(dependency)
+                            work.append(
+                                (dependency, iter(self.dependencies[dependency]))
+                            )
+                            break
+                        elif dependency in on_stack:
+                            lowlink[package] = min(lowlink[package], index[dependency])
+                    else:
+                        work.pop()
+                        if work:
+                            parent = work[-1][0]
+                            lowlink[parent] = min(lowlink[parent], lowlink[package])
+                        if lowlink[package] == index[package]:
+                            component = []
+                            while True:
+                                p = stack.pop()
+                                on_stack.discard(p)
+                                component.append(p)
+                                if p == package:
+                                    break
+                            if (
+                                len(component) > 1
+                                or package in self.dependencies[package]
+                            ):
+                                cycles.append(sorted(component))
+            self._cycles = cycles
+        return self._cycles
+
+    def closure(self, packages, reverse=False, depth=None):
+        """
+        Return a dictionary whose keys are the given packages and all the
+        packages they depend on (or that depend on them if reverse is True)
+        and values are their distance to given packages. Keys are in breadth
+        first order. If depth is given, packages farther than depth are
+        ignored.
+        """
+        adjacency = self.dependents if reverse else self.dependencies
+        result = {}
+        queue = collections.deque()
+        for package in packages:
+            if package not in self.recipes:
+                raise KeyError(package)
+            if package not in result:
+                result[package] = 0
+                queue.append(package)
+        while queue:
+            package = queue.popleft()
+            distance = result[package] + 1
+            if depth is not None and distance > depth:
                 continue
-            dependency = requirement.split(None, 1)[0]
-            no_dependency.discard(dependency)
-            if dependency not in recipes:
-                recipe["soma-forge"].setdefault("requirements", {}).setdefault(
-                    "conda-forge", set()
-                ).add(dependency)
-            else:
-                type = recipe["soma-forge"]["type"]
-                if type == "virtual":
-                    type = "brainvisa-cmake"
-                recipe["soma-forge"].setdefault("requirements", {}).setdefault(
-                    type, set()
-                ).add(dependency)
+            for other in adjacency[package]:
+                if other not in result:
+                    result[other] = distance
+                    queue.append(other)
+        return result
+
+
+# Graph built by recipe_graph() and the recipe files state it was built from
+recipe_graph_cache = {}
+
+
+def recipe_graph():
+    """
+    Return the RecipeGraph of all recipes. The graph is built once per process
+    and only built again if recipe files are modified.
+    """
+    key = tuple(
+        (str(i), i.stat().st_mtime_ns, i.stat().st_size)
+        for i in sorted((pixi_root / "recipes").glob("*/recipe.yaml"))
+    )
+    if recipe_graph_cache.get("key") != key:
+        recipe_graph_cache["graph"] = RecipeGraph(read_recipes())
+        recipe_graph_cache["key"] = key
+    return recipe_graph_cache["graph"]
+
+
+def selected_recipes(selection=None):
+    """
+    Iterate over recipes selected in configuration and their dependencies.
+    """
+    graph = recipe_graph()
 
     # Read soma-forge configuration
     config_file = pixi_root / "conf" / "soma-forge.yaml"
-    all_packages = set(recipes)
+    all_packages = set(graph.recipes)
     selected_packages = all_packages
     if config_file.exists():
-        with open(config_file) as f:
-            config = yaml.safe_load(f)
-            s = config.get("packages")
-            if s:
-                selected_packages = list(s)
+        config = read_yaml_files([config_file])[str(config_file)]
+        s = config.get("packages")
+        if s:
+            selected_packages = list(s)
     metapackages = {
         "all": all_packages,
         "selected": selected_packages,
@@ -93,82 +353,1185 @@ def selected_recipes(selection=None):
             selected_packages.update(s)
 
     # Walk over selected packages and dependencies
-    stack = list(selected_packages)
-    done = set()
-    while stack:
-        package = stack.pop(0)
-        if package in done:
-            continue
-        recipe = recipes[package]
-        yield recipe
-        done.add(package)
-        dependencies = (
-            recipe["soma-forge"]
-            .get("requirements", {})
-            .get("brainvisa-cmake", set())
-            .union(
-                recipe["soma-forge"].get("requirements", {}).get("soma-forge", set())
-            )
-        )
-        stack.extend(i for i in dependencies if i not in done)
+    for package in graph.closure(sorted(selected_packages)):
+        yield graph.recipes[package]
+
+
+def build_durations():
+    """
+    Return a dictionary whose keys are package names and values are the wall
+    time of their last successful build (see build_durations_file).
+    """
+    durations = read_build_durations()
+    if durations is None:
+        durations = update_build_durations()
+    return durations
 
 
 def sorted_recipies():
     """
     Iterate over recipes sorted according to their depencencies starting with a
-    package without dependency.
-    """
-    recipes = {r["package"]["name"]: r for r in selected_recipes()}
-    ready = set()
-    inverted_dependencies = {}
-    for package, recipe in recipes.items():
-        dependencies = (
-            recipe["soma-forge"]
-            .get("requirements", {})
-            .get("brainvisa-cmake", set())
-            .union(
-                recipe["soma-forge"].get("requirements", {}).get("soma-forge", set())
-            )
+    package without dependency. When several packages are ready, the one
+    having the longest chain of dependent packages is yielded first. The
+    duration of this chain is stored in recipe["soma-forge"]["priority"]. It
+    is computed from the last build durations recorded in history. Packages
+    that were never built are given the average duration of the other
+    packages. Raise ValueError if there are dependency cycles.
+    """
+    graph = recipe_graph()
+    selected = {r["package"]["name"] for r in selected_recipes()}
+    order = [package for package in graph.topological_order() if package in selected]
+
+    # Compute the duration of the longest chain starting with each package
+    durations = build_durations()
+    known = [durations[i] for i in selected if i in durations]
+    default_duration = sum(known) / len(known) if known else 1.0
+    priority = {}
+    for package in reversed(order):
+        priority[package] = durations.get(package, default_duration) + max(
+            (priority[i] for i in graph.dependents[package] if i in selected),
+            default=0.0,
         )
-        if not dependencies:
-            ready.add(package)
-        for dependency in dependencies:
-            inverted_dependencies.setdefault(dependency, set()).add(package)
+        graph.recipes[package]["soma-forge"]["priority"] = priority[package]
 
-    done = set()
+    remaining = {package: len(graph.dependencies[package]) for package in order}
+    ready = [(-priority[p], p) for p, count in remaining.items() if count == 0]
+    heapq.heapify(ready)
     while ready:
-        package = ready.pop()
-        yield recipes[package]
-        done.add(package)
-        for dependent in inverted_dependencies.get(package, []):
-            dependencies = (
-                recipes[dependent]["soma-forge"]
-                .get("requirements", {})
-                .get("brainvisa-cmake", set())
-                .union(
-                    recipes[dependent]["soma-forge"]
-                    .get("requirements", {})
-                    .get("soma-forge", set())
-                )
+        _, package = heapq.heappop(ready)
+        yield graph.recipes[package]
+        for dependent in graph.dependents[package]:
+            if dependent in remaining:
+                remaining[dependent] -= 1
+                if remaining[dependent] == 0:
+                    heapq.heappush(ready, (-priority[dependent], dependent))
+
+
+# Sub-directories of local forge channel
+forge_subdirs = ("linux-64", "noarch")
+
+# Name of the sharded repodata index written in each forge sub-directory
+# next to repodata.json (see index_forge()). Shards are stored in the
+# "shards" sub-directory.
+shards_index_name = "repodata_shards.msgpack.zst"
+
+
+def read_package_index(package_file):
+    """
+    Return the content of info/index.json from a Conda package file (either
+    .conda or .tar.bz2 format).
+    """
+    # zstandard and msgpack are imported by the functions using them because
+    # soma_forge is also imported in rattler-build environments that do not
+    # contain them.
+    import zstandard
+
+    package_file = pathlib.Path(package_file)
+    if package_file.name.endswith(".conda"):
+        with zipfile.ZipFile(package_file) as z:
+            info = next(
+                (
+                    i
+                    for i in z.namelist()
+                    if i.startswith("info-") and i.endswith(".tar.zst")
+                ),
+                None,
             )
-            if all(d in done for d in dependencies):
-                ready.add(dependent)
+            if info is not None:
+                with z.open(info) as f, zstandard.ZstdDecompressor().stream_reader(
+                    f
+                ) as stream, tarfile.open(fileobj=stream, mode="r|") as tar:
+                    for member in tar:
+                        if member.name == "info/index.json":
+                            return json.load(tar.extractfile(member))
+    else:
+        with tarfile.open(package_file, "r:bz2") as tar:
+            return json.load(tar.extractfile("info/index.json"))
+    raise ValueError(f"{package_file} does not contain info/index.json")
+
+
+def package_file_info(package_file):
+    """
+    Return the repodata entry of a Conda package file: the content of its
+    index.json with its size and digests.
+    """
+    package_info = read_package_index(package_file)
+    md5 = hashlib.md5()
+    sha256 = hashlib.sha256()
+    size = 0
+    with open(package_file, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            md5.update(chunk)
+            sha256.update(chunk)
+            size += len(chunk)
+    package_info.update(md5=md5.hexdigest(), sha256=sha256.hexdigest(), size=size)
+    return package_info
+
+
+def write_shards(directory, repodata, stamp):
+    """
+    Write sharded repodata in a forge sub-directory: one compressed msgpack
+    file per package name, named after its sha256 digest, and an index
+    associating package names to these digests. Only new shards are written
+    and shards that are no longer referenced are removed. The index records
+    the modification time and size of the repodata.json file it was computed
+    from.
+    """
+    import msgpack
+    import zstandard
+
+    shards_dir = directory / "shards"
+    shards_dir.mkdir(exist_ok=True)
+    compressor = zstandard.ZstdCompressor()
+    by_name = {}
+    for key in ("packages", "packages.conda"):
+        for file, package_info in repodata.get(key, {}).items():
+            package_info = dict(package_info)
+            for digest in ("md5", "sha256"):
+                if isinstance(package_info.get(digest), str):
+                    package_info[digest] = bytes.fromhex(package_info[digest])
+            shard = by_name.setdefault(
+                package_info["name"],
+                {"packages": {}, "packages.conda": {}, "removed": []},
+            )
+            shard[key][file] = package_info
+    shards = {}
+    for name, shard in sorted(by_name.items()):
+        content = compressor.compress(msgpack.packb(shard))
+        digest = hashlib.sha256(content).digest()
+        shard_file = shards_dir / f"{digest.hex()}.msgpack.zst"
+        if not shard_file.exists():
+            write_atomic(shard_file, content)
+        shards[name] = digest
+    index = {
+        "version": 1,
+        "info": {
+            "base_url": "",
+            "shards_base_url": "./shards/",
+            "subdir": directory.name,
+            "soma_forge_repodata": stamp,
+        },
+        "shards": shards,
+    }
+    write_atomic(
+        directory / shards_index_name, compressor.compress(msgpack.packb(index))
+    )
+    referenced = {f"{i.hex()}.msgpack.zst" for i in shards.values()}
+    for shard_file in shards_dir.iterdir():
+        if shard_file.name not in referenced:
+            shard_file.unlink(missing_ok=True)
+
+
+# Serialize updates of local forge repodata files
+forge_repodata_lock = threading.Lock()
+
+
+def index_forge():
+    """
+    Update local forge repodata incrementally. Only package files that are not
+    yet in repodata.json (or whose size changed) are read, and entries of
+    removed files are dropped. repodata.json is then written with its
+    compressed version (repodata.json.zst) and its sharded version (see
+    write_shards()). Compressed and sharded files are also rewritten if
+    repodata.json was modified by another tool (e.g. rattler-build). Return a
+    dictionary whose keys are forge sub-directories and values are the lists
+    of added and removed package files.
+    """
+    import zstandard
+
+    changes = {}
+    forge_dir = pixi_root / "forge"
+    forge_dir.mkdir(exist_ok=True)
+    # The file lock serializes updates made by several processes sharing the
+    # same forge (e.g. farm workers)
+    with forge_repodata_lock, open(forge_dir / ".index.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        for subdir in forge_subdirs:
+            directory = forge_dir / subdir
+            directory.mkdir(exist_ok=True)
+            repodata_file = directory / "repodata.json"
+            try:
+                with open(repodata_file) as f:
+                    repodata = json.load(f)
+            except FileNotFoundError:
+                repodata = {}
+            repodata.setdefault("info", {"subdir": subdir})
+            repodata.setdefault("packages", {})
+            repodata.setdefault("packages.conda", {})
+            repodata.setdefault("removed", [])
+            repodata.setdefault("repodata_version", 1)
+
+            files = {
+                path.name: path
+                for path in directory.iterdir()
+                if path.name.endswith((".conda", ".tar.bz2"))
+            }
+            added = []
+            removed = []
+            for key in ("packages", "packages.conda"):
+                for file in list(repodata[key]):
+                    if file not in files:
+                        del repodata[key][file]
+                        removed.append(file)
+            for file, path in sorted(files.items()):
+                key = "packages.conda" if file.endswith(".conda") else "packages"
+                package_info = repodata[key].get(file)
+                if package_info and package_info.get("size") == path.stat().st_size:
+                    continue
+                try:
+                    repodata[key][file] = package_file_info(path)
+                except (OSError, ValueError, zipfile.BadZipFile, tarfile.TarError) as e:
+                    print(f"WARNING: cannot index {path}: {e}", file=sys.stderr)
+                    continue
+                added.append(file)
+            changes[subdir] = (added, removed)
+
+            content = json.dumps(repodata, indent=2, sort_keys=True).encode()
+            if added or removed or not repodata_file.exists():
+                write_atomic(repodata_file, content)
+            stat = repodata_file.stat()
+            stamp = [stat.st_mtime_ns, stat.st_size]
+            if read_shards_index(directory, stamp) is None:
+                write_atomic(
+                    directory / "repodata.json.zst",
+                    zstandard.ZstdCompressor().compress(content),
+                )
+                write_shards(directory, repodata, stamp)
+    return changes
+
+
+def read_shards_index(directory, stamp):
+    """
+    Return the shards index of a forge sub-directory if it exists and was
+    computed from the repodata.json file whose modification time and size
+    are given in stamp. Otherwise return None.
+    """
+    import msgpack
+    import zstandard
+
+    try:
+        with open(directory / shards_index_name, "rb") as f:
+            index = msgpack.unpackb(zstandard.ZstdDecompressor().decompress(f.read()))
+    except (OSError, ValueError, zstandard.ZstdError):
+        return None
+    if index.get("info", {}).get("soma_forge_repodata") != stamp:
+        return None
+    return index.get("shards", {})
+
+
+def read_shard(directory, digest):
+    """
+    Return the content of a repodata shard with digests converted back to
+    hexadecimal strings.
+    """
+    import msgpack
+    import zstandard
+
+    shard_file = directory / "shards" / f"{digest.hex()}.msgpack.zst"
+    with open(shard_file, "rb") as f:
+        shard = msgpack.unpackb(zstandard.ZstdDecompressor().decompress(f.read()))
+    for key in ("packages", "packages.conda"):
+        for package_info in shard.get(key, {}).values():
+            for digest_key in ("md5", "sha256"):
+                if isinstance(package_info.get(digest_key), bytes):
+                    package_info[digest_key] = package_info[digest_key].hex()
+    return shard
 
 
-def forged_packages(name_re):
+def index_packages(directory, repodata):
     """
-    Iterate over name of packages that exists in local forge
+    Return the packages of a repodata dictionary indexed by package name then
+    by (version, build).
     """
+    index = {}
+    for key in ("packages", "packages.conda"):
+        for file, package_info in repodata.get(key, {}).items():
+            package_info["path"] = str(directory / file)
+            index.setdefault(package_info["name"], {})[
+                (package_info.get("version"), package_info.get("build"))
+            ] = package_info
+    return index
+
+
+# Content of local forge indexed by sub-directory. Each value is a dictionary
+# with the modification time and size of the repodata.json file ("stamp"),
+# its shards index if it is up to date ("shards"), the packages already
+# loaded indexed by name then by (version, build) ("packages") and whether
+# all packages are loaded ("complete").
+forge_index_cache = {}
+forge_index_lock = threading.Lock()
+
+
+def forge_index(name=None):
+    """
+    Return an index of the packages that exists in local forge. It is a
+    dictionary whose keys are package names and values are dictionaries
+    whose keys are (version, build) and values are package info. If a name
+    is given, only this package is looked for and, if sharded repodata is up
+    to date, only its shard is read. Otherwise, repodata.json files are
+    read. Files are only read once per process unless repodata.json
+    modification time changes.
+    """
+    result = {}
+    with forge_index_lock:
+        for subdir in forge_subdirs:
+            directory = pixi_root / "forge" / subdir
+            try:
+                stat = (directory / "repodata.json").stat()
+            except FileNotFoundError:
+                forge_index_cache.pop(subdir, None)
+                continue
+            stamp = [stat.st_mtime_ns, stat.st_size]
+            cached = forge_index_cache.get(subdir)
+            if cached is None or cached["stamp"] != stamp:
+                cached = forge_index_cache[subdir] = {
+                    "stamp": stamp,
+                    "shards": read_shards_index(directory, stamp),
+                    "packages": {},
+                    "complete": False,
+                }
+            packages = cached["packages"]
+            if not cached["complete"]:
+                if name is not None and cached["shards"] is not None:
+                    if name not in packages:
+                        digest = cached["shards"].get(name)
+                        packages[name] = (
+                            index_packages(
+                                directory, read_shard(directory, digest)
+                            ).get(name, {})
+                            if digest
+                            else {}
+                        )
+                else:
+                    with open(directory / "repodata.json") as f:
+                        packages = cached["packages"] = index_packages(
+                            directory, json.load(f)
+                        )
+                    cached["complete"] = True
+            if name is not None:
+                if packages.get(name):
+                    result.setdefault(name, {}).update(packages[name])
+            else:
+                for package_name, package_versions in packages.items():
+                    result.setdefault(package_name, {}).update(package_versions)
+    return result
+
+
+def forged_packages(name_re=None, name=None):
+    """
+    Iterate over packages that exists in local forge. Packages can be
+    selected either with a regular expression matching their name or with
+    their exact name.
+    """
+    index = forge_index(name)
+    if name is not None:
+        for package_info in index.get(name, {}).values():
+            yield dict(package_info)
+        return
     if isinstance(name_re, str):
         name_re = re.compile(name_re)
-    for repodata_file in (pixi_root / "forge").glob("*/repodata.json"):
-        with open(repodata_file) as f:
-            repodata = json.load(f)
-        for file, package_info in repodata.get("packages.conda", {}).items():
-            name = package_info["name"]
-            if name_re.match(name):
-                package_info["path"] = str(pathlib.Path(repodata_file).parent / file)
-                yield package_info
+    for package_name, packages in index.items():
+        if name_re is None or name_re.match(package_name):
+            for package_info in packages.values():
+                yield dict(package_info)
+
+
+def forge_references():
+    """
+    Return the paths (relative to local forge) of the package files that are
+    used by the pixi project: either locked in pixi.lock or installed in one
+    of the environments in .pixi/envs.
+    """
+    forge_url = (pixi_root / "forge").as_uri() + "/"
+    urls = []
+    lock_file = pixi_root / "pixi.lock"
+    if lock_file.exists():
+        urls.extend(re.findall(r"(?:conda|url):\s*(\S+)", lock_file.read_text()))
+    for meta_file in (pixi_root / ".pixi" / "envs").glob("*/conda-meta/*.json"):
+        try:
+            with open(meta_file) as f:
+                url = json.load(f).get("url")
+        except (OSError, ValueError):
+            continue
+        if url:
+            urls.append(url)
+    return {i[len(forge_url) :] for i in urls if i.startswith(forge_url)}
+
+
+def recipe_components(recipe):
+    """
+    Return the list of brainvisa-cmake components installed by the build
+    script of a recipe.
+    """
+    script = recipe.get("build", {}).get("script")
+    if not isinstance(script, str):
+        return []
+    components = []
+    for m in re.finditer(
+        r"^\s*(?:for\s+component\s+in|python\s+\S*soma_forge/install\.py\"?)"
+        r"\s+([^;\n]*)",
+        script,
+        re.M,
+    ):
+        components.extend(i for i in m.group(1).split() if not i.startswith("-"))
+    return components
+
+
+def casa_build():
+    """
+    Return the bv_maker build directory
+    """
+    return pathlib.Path(os.environ.get("CASA_BUILD", pixi_root / "build"))
+
+
+def casa_src():
+    """
+    Return the bv_maker sources directory
+    """
+    return pathlib.Path(os.environ.get("CASA_SRC", pixi_root / "src"))
+
+
+# File created after a successful soma_forge build. It contains the state of
+# sources components that were built (see build_state()).
+build_success_file = pixi_root / "build" / "success"
+
+
+def git_repositories(directory, max_depth=3):
+    """
+    Iterate over git repositories found in a directory. Do not look inside
+    repositories.
+    """
+    stack = [(pathlib.Path(directory), 0)]
+    while stack:
+        path, depth = stack.pop()
+        if (path / ".git").exists():
+            yield path
+            continue
+        if depth < max_depth and path.is_dir():
+            for child in sorted(path.iterdir(), reverse=True):
+                if child.is_dir() and not child.name.startswith("."):
+                    stack.append((child, depth + 1))
+
+
+def git_state(repository):
+    """
+    Return the state of a git repository as a dictionary containing its HEAD
+    commit ("head"), a hash of its working tree changes ("changes") and the
+    list of files modified in the working tree ("modified").
+    """
+    head = subprocess.run(
+        ["git", "-C", str(repository), "rev-parse", "HEAD"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    ).stdout.strip()
+    status = subprocess.run(
+        ["git", "-C", str(repository), "status", "--porcelain", "-z"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    ).stdout
+    modified = []
+    entries = iter(status.split(b"\0"))
+    for entry in entries:
+        if len(entry) > 3:
+            modified.append(entry[3:].decode())
+            if entry[:1] in (b"R", b"C"):
+                # Renamed or copied files are followed by their original path
+                modified.append(next(entries, b"").decode())
+    modified.sort()
+    hash = hashlib.sha256(status)
+    for file in modified:
+        path = repository / file
+        if path.is_file():
+            stat = path.stat()
+            hash.update(f"{file}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    return {"head": head, "changes": hash.hexdigest(), "modified": modified}
+
+
+def bv_maker_config_file():
+    """
+    Return the bv_maker configuration file
+    """
+    return pathlib.Path(
+        os.environ.get("BRAINVISA_BVMAKER_CFG", pixi_root / "conf" / "bv_maker.cfg")
+    )
+
+
+def component_source_dirs():
+    """
+    Return a dictionary whose keys are source directories (relative to
+    $CASA_SRC) declared in bv_maker configuration and values are the set of
+    components whose sources are in these directories. Directories are
+    either given by `directory` in build sections or by the optional
+    directory of `git` lines (or default_source_dir) in source sections.
+    Components of projects (such as `brainvisa brainvisa-cea ...` lines) are
+    not listed.
+    """
+    config_file = bv_maker_config_file()
+    if not config_file.exists():
+        return {}
+    src = casa_src()
+    source_dirs = {}
+    section = None
+    default_source_dir = "{component}"
+    component = None
+    for line in config_file.read_text().splitlines():
+        line = line.strip()
+        if line.startswith("["):
+            section = line.strip("[]").split()[0]
+            component = None
+            continue
+        if line.startswith("- "):
+            component = line[2:].strip()
+            directory = None
+            if section == "source":
+                directory = default_source_dir.replace("{component}", component)
+        elif line.startswith("default_source_dir") and "=" in line:
+            default_source_dir = line.split("=", 1)[1].strip()
+            continue
+        elif component and line.startswith("directory "):
+            directory = line.split(None, 1)[1]
+        elif component and section == "source" and line.startswith("git "):
+            args = line.split()
+            if len(args) < 5:
+                continue
+            directory = args[4].replace("{component}", component)
+        else:
+            continue
+        if directory is None:
+            continue
+        directory = pathlib.Path(
+            os.path.expandvars(directory.replace("$CASA_SRC", str(src)))
+        )
+        if not directory.is_absolute():
+            directory = src / directory
+        if src in directory.parents:
+            source_dirs.setdefault(directory.relative_to(src).as_posix(), set()).add(
+                component
+            )
+    return source_dirs
+
+
+def build_state():
+    """
+    Return the current state of sources used by bv_maker: the hash of
+    bv_maker configuration ("config") and the git state (see git_state())
+    of each component repository in $CASA_SRC ("components").
+    """
+    src = casa_src()
+    config_file = bv_maker_config_file()
+    config = None
+    if config_file.exists():
+        config = hashlib.sha256(config_file.read_bytes()).hexdigest()
+    repositories = list(git_repositories(src))
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        states = executor.map(git_state, repositories)
+    return {
+        "config": config,
+        "components": {
+            str(repository.relative_to(src)): state
+            for repository, state in zip(repositories, states)
+        },
+    }
+
+
+def read_build_state():
+    """
+    Return the state recorded in build_success_file after the last successful
+    build or None if there is no such build. The "doc" item of the state
+    tells whether documentation was built.
+    """
+    if not build_success_file.exists():
+        return None
+    try:
+        with open(build_success_file) as f:
+            return json.load(f)
+    except ValueError:
+        # Empty file written by older versions
+        return {}
+
+
+def write_build_state(state):
+    """
+    Write build_success_file
+    """
+    build_success_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(build_success_file, "w") as f:
+        json.dump(state, f, indent=4)
+
+
+def build_steps(previous, current, doc=True):
+    """
+    Return the list of bv_maker steps to run to go from a previous build
+    state to the current one: "configure" if the configuration, the list of
+    components or any CMake file changed, "build" if any component changed
+    and "doc" if doc is True and the documentation is not up to date.
+    """
+    if not previous or previous.get("config") != current["config"]:
+        steps = ["configure", "build"]
+    elif previous.get("components", {}).keys() != current["components"].keys():
+        steps = ["configure", "build"]
+    else:
+        steps = []
+        for component, state in current["components"].items():
+            old = previous["components"][component]
+            if old == state:
+                continue
+            if "build" not in steps:
+                steps.append("build")
+            changed = set(state["modified"]).union(old["modified"])
+            if old["head"] != state["head"]:
+                diff = subprocess.run(
+                    [
+                        "git",
+                        "-C",
+                        str(casa_src() / component),
+                        "diff",
+                        "--name-only",
+                        old["head"],
+                        state["head"],
+                    ],
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.DEVNULL,
+                    universal_newlines=True,
+                )
+                if diff.returncode:
+                    # Old HEAD is unknown (e.g. history rewritten)
+                    steps = ["configure", "build"]
+                    break
+                changed.update(diff.stdout.split())
+            if any(
+                os.path.basename(i) == "CMakeLists.txt" or i.endswith(".cmake")
+                for i in changed
+            ):
+                steps = ["configure", "build"]
+                break
+    if doc and (steps or not previous or not previous.get("doc")):
+        steps.append("doc")
+    return steps
+
+
+def tree_digest(directory, hash=None):
+    """
+    Update a hash with the name, size and modification time of all files in
+    a directory tree. Return the hash object.
+    """
+    if hash is None:
+        hash = hashlib.sha256()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for file in sorted(files):
+            path = os.path.join(root, file)
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                # Broken symlink
+                continue
+            hash.update(
+                f"{os.path.relpath(path, directory)}\0{stat.st_size}\0"
+                f"{stat.st_mtime_ns}\0".encode()
+            )
+    return hash
+
+
+def recipe_fingerprint(recipe, fingerprints, project):
+    """
+    Return a hash of everything a package build depends on: the files of its
+    recipe directory, the pixi project definition (that contains the distro
+    version and channels), the fingerprints of the soma-forge packages it
+    depends on (taken from fingerprints dictionary) and, for brainvisa-cmake
+    packages, the state of the build directories of its components in
+    $CASA_BUILD.
+    """
+    hash = hashlib.sha256()
+    hash.update(json.dumps(project, sort_keys=True).encode())
+    recipe_dir = pathlib.Path(recipe["soma-forge"]["recipe_dir"])
+    for path in sorted(recipe_dir.rglob("*")):
+        if path.is_file():
+            hash.update(f"{path.relative_to(recipe_dir)}\0".encode())
+            hash.update(path.read_bytes())
+    for dependency in sorted(recipe_dependencies(recipe)):
+        hash.update(f"{dependency}\0{fingerprints.get(dependency)}\0".encode())
+    if recipe["soma-forge"]["type"] == "brainvisa-cmake":
+        build_files = casa_build() / "build_files"
+        for component in recipe_components(recipe):
+            hash.update(f"{component}\0".encode())
+            tree_digest(build_files / component, hash)
+    return hash.hexdigest()
+
+
+# inotify events used by DirectoryWatcher (see inotify(7))
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+inotify_event = struct.Struct("iIII")
+
+
+def ignored_file(name):
+    """
+    Return True for files that must not trigger a rebuild: hidden files
+    (including .git directories), editor backup files and Python caches.
+    """
+    return name.startswith(".") or name.endswith("~") or name == "__pycache__"
+
+
+class DirectoryWatcher:
+    """
+    Watch directory trees for file modifications using Linux inotify. New
+    subdirectories are automatically watched.
+    """
+
+    mask = (
+        IN_CLOSE_WRITE
+        | IN_MOVED_FROM
+        | IN_MOVED_TO
+        | IN_CREATE
+        | IN_DELETE
+        | IN_DELETE_SELF
+    )
+
+    def __init__(self, directories):
+        self.libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = self.libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            error = ctypes.get_errno()
+            raise OSError(error, f"inotify_init1: {os.strerror(error)}")
+        self.watches = {}
+        self.limit_reached = False
+        for directory in directories:
+            self.add_tree(directory)
+
+    def add_tree(self, directory):
+        for root, dirs, files in os.walk(directory):
+            dirs[:] = [i for i in dirs if not ignored_file(i)]
+            wd = self.libc.inotify_add_watch(self.fd, os.fsencode(root), self.mask)
+            if wd < 0:
+                error = ctypes.get_errno()
+                if error == errno.ENOSPC and not self.limit_reached:
+                    self.limit_reached = True
+                    print(
+                        "WARNING: inotify watch limit reached, some directories "
+                        "are not watched (see fs.inotify.max_user_watches)",
+                        file=sys.stderr,
+                        flush=True,
+                    )
+                continue
+            self.watches[wd] = pathlib.Path(root)
+
+    def read(self, timeout=None):
+        """
+        Wait at most timeout seconds (forever if None) for modifications and
+        return the set of modified paths. None is in the set if some events
+        were lost.
+        """
+        changed = set()
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return changed
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                break
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, length = inotify_event.unpack_from(data, offset)
+                offset += inotify_event.size
+                name = os.fsdecode(data[offset : offset + length].rstrip(b"\0"))
+                offset += length
+                if mask & IN_Q_OVERFLOW:
+                    changed.add(None)
+                    continue
+                directory = self.watches.get(wd)
+                if mask & IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if directory is None or ignored_file(name):
+                    continue
+                path = directory / name if name else directory
+                if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                    self.add_tree(path)
+                changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Measurements of packages builds, tests and bv_maker steps are appended to
+# this file, one JSON record per line.
+history_file = pixi_root / "forge" / "history.jsonl"
+history_lock = threading.Lock()
+
+# Wall time of the last successful build of each package. It is updated by
+# record_history() so that planning does not have to read the whole history.
+build_durations_file = pixi_root / "forge" / "cache" / "build-durations.json"
+
+
+# Directory containing compressed output of packages builds, tests and
+# bv_maker steps
+logs_dir = pixi_root / "forge" / "logs"
+# Number of output lines kept in memory for commands whose output is logged
+log_tail_lines = 50
+
+
+def measured_run(command, log_file=None, progress=None, **kwargs):
+    """
+    Run a command like subprocess.run() and measure its resources usage.
+    Return the CompletedProcess and a dictionary containing the wall time
+    ("wall") and CPU time ("cpu") in seconds and the peak resident memory in
+    bytes ("max_rss"). CPU time includes all descendant processes, peak
+    memory is the one of the biggest process of the tree.
+
+    If log_file is given, standard and error outputs of the command are
+    written in this gzip compressed file while the command runs, progress
+    (if given) is called with each output line and the stdout attribute of
+    the returned CompletedProcess contains the last log_tail_lines lines.
+    """
+    if log_file is not None:
+        kwargs.update(stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    kwargs.setdefault("pass_fds", jobserver_fds())
+    start = time.monotonic()
+    p = subprocess.Popen(command, **kwargs)
+    stdout = None
+    if log_file is not None:
+        log_file = pathlib.Path(log_file)
+        log_file.parent.mkdir(parents=True, exist_ok=True)
+        tail = collections.deque(maxlen=log_tail_lines)
+        with gzip.open(log_file, "wb", compresslevel=1) as log:
+            for line in p.stdout:
+                log.write(line)
+                tail.append(line)
+                if progress is not None:
+                    progress(line)
+        p.stdout.close()
+        stdout = b"".join(tail).decode(errors="replace")
+    elif p.stdout is not None:
+        stdout = p.stdout.read()
+        p.stdout.close()
+    _, status, rusage = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)
+    metrics = {
+        "wall": time.monotonic() - start,
+        "cpu": rusage.ru_utime + rusage.ru_stime,
+        "max_rss": rusage.ru_maxrss * 1024,
+    }
+    return subprocess.CompletedProcess(command, p.returncode, stdout), metrics
+
+
+def record_history(kind, name, metrics, **kwargs):
+    """
+    Append a measurement to history_file. kind is one of "package", "test"
+    or "bv_maker", name identifies what was measured (package name, test
+    label or bv_maker steps).
+    """
+    record = dict(time=time.time(), kind=kind, name=name, **metrics, **kwargs)
+    line = json.dumps(record) + "\n"
+    with history_lock:
+        history_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(history_file, "a") as f:
+            f.write(line)
+    if kind == "package" and not kwargs.get("returncode"):
+        update_build_durations(name, metrics["wall"])
+
+
+def read_history(kind=None):
+    """
+    Iterate over records of history_file, optionally selecting one kind of
+    record.
+    """
+    if not history_file.exists():
+        return
+    with open(history_file) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                record = json.loads(line)
+                if kind is None or record["kind"] == kind:
+                    yield record
+
+
+def read_build_durations():
+    """
+    Return the content of build_durations_file or None if it does not exist
+    """
+    try:
+        with open(build_durations_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def update_build_durations(package=None, wall=None):
+    """
+    Record the wall time of the last successful build of a package in
+    build_durations_file and return its new content. If the file does not
+    exist yet (e.g. history written by an older version), it is first
+    computed from history_file.
+    """
+    build_durations_file.parent.mkdir(parents=True, exist_ok=True)
+    lock_file = build_durations_file.with_name(f".{build_durations_file.name}.lock")
+    # The file lock serializes updates made by several processes sharing the
+    # same forge (e.g. farm workers)
+    with history_lock, open(lock_file, "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        durations = read_build_durations()
+        if durations is None:
+            durations = {}
+            for record in read_history("package"):
+                if not record["returncode"]:
+                    durations[record["name"]] = record["wall"]
+        if package is not None:
+            durations[package] = wall
+        write_atomic(
+            build_durations_file,
+            json.dumps(durations, indent=2, sort_keys=True).encode(),
+        )
+    return durations
+
+
+# Compiler cache shared by bv_maker and all packages builds
+ccache_dir = pixi_root / "forge" / "ccache"
+
+
+def setup_compiler_cache():
+    """
+    Configure environment so that CMake uses ccache (if it is installed) for
+    all C and C++ compilations of child processes. The cache directory is
+    shared by all builds and paths are hashed relative to the pixi project in
+    order to get cache hits between different work directories. Return True
+    if ccache is used.
+    """
+    ccache = shutil.which("ccache")
+    if not ccache:
+        return False
+    os.environ.setdefault("CCACHE_DIR", str(ccache_dir))
+    os.environ.setdefault("CCACHE_BASEDIR", str(pixi_root))
+    os.environ.setdefault("CCACHE_NOHASHDIR", "true")
+    os.environ.setdefault("CCACHE_COMPILERCHECK", "content")
+    for language in ("C", "CXX"):
+        os.environ.setdefault(f"CMAKE_{language}_COMPILER_LAUNCHER", ccache)
+    return True
+
+
+def compiler_cache_stats():
+    """
+    Return ccache statistics counters as a dictionary or None if ccache is
+    not used.
+    """
+    ccache = os.environ.get("CMAKE_CXX_COMPILER_LAUNCHER")
+    if not ccache:
+        return None
+    result = subprocess.run(
+        [ccache, "--print-stats"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+        universal_newlines=True,
+    )
+    if result.returncode:
+        return None
+    stats = {}
+    for line in result.stdout.splitlines():
+        key, _, value = line.partition("\t")
+        if value.isdigit():
+            stats[key] = int(value)
+    return stats
+
+
+def compiler_cache_summary(before, after):
+    """
+    Return a message giving the number of compiler cache hits and misses
+    between two results of compiler_cache_stats() or None if ccache is not
+    used.
+    """
+    if before is None or after is None:
+        return None
+
+    def delta(key):
+        return after.get(key, 0) - before.get(key, 0)
+
+    hits = delta("direct_cache_hit") + delta("preprocessed_cache_hit")
+    misses = delta("cache_miss")
+    total = hits + misses
+    rate = f" ({100 * hits / total:.0f}% hits)" if total else ""
+    return f"Compiler cache: {hits} hits, {misses} misses{rate}"
+
+
+def memory_usage():
+    """
+    Return the memory used on the host in bytes
+    """
+    meminfo = {}
+    with open("/proc/meminfo") as f:
+        for line in f:
+            key, value = line.split(":", 1)
+            meminfo[key] = int(value.split()[0]) * 1024
+    return meminfo["MemTotal"] - meminfo["MemAvailable"]
+
+
+def make_version():
+    """
+    Return the version of make found in PATH as a tuple of integers
+    """
+    try:
+        o = subprocess.check_output(
+            ["make", "--version"], stderr=subprocess.DEVNULL, universal_newlines=True
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return ()
+    m = re.search(r"(\d+(?:\.\d+)*)", o)
+    return tuple(int(i) for i in m.group(1).split(".")) if m else ()
+
+
+class JobServer:
+    """
+    GNU make jobserver shared by all child processes. It is published in
+    MAKEFLAGS so that every make started by bv_maker, rattler-build or recipes
+    scripts draws its jobs from the same pool of tokens. soma_forge also takes
+    a token for each package it builds concurrently (see job_slot()). The
+    named pipe protocol is used with make >= 4.4, otherwise tokens are in an
+    anonymous pipe whose file descriptors are inherited by child processes
+    (make processes started by bv_maker do not get them and keep their own
+    number of jobs).
+    If a memory limit (in bytes) is given, tokens are withheld from the pool
+    while the memory used on the host is above this limit.
+    """
+
+    def __init__(self, jobs, memory_limit=None):
+        self.jobs = max(jobs, 1)
+        self.memory_limit = memory_limit
+        self.directory = None
+        if make_version() >= (4, 4):
+            self.directory = tempfile.mkdtemp(prefix="soma-forge-jobserver-")
+            fifo = os.path.join(self.directory, "fifo")
+            os.mkfifo(fifo, 0o600)
+            # Opening in read/write mode does not wait for another process to
+            # open the fifo.
+            self.read_fd = self.write_fd = os.open(fifo, os.O_RDWR)
+            auth = f"fifo:{fifo}"
+        else:
+            self.read_fd, self.write_fd = os.pipe()
+            os.set_inheritable(self.read_fd, True)
+            os.set_inheritable(self.write_fd, True)
+            auth = f"{self.read_fd},{self.write_fd}"
+        # One token is implicitly owned by the first job
+        os.write(self.write_fd, b"+" * (self.jobs - 1))
+        self.withheld = []
+        self.stop = threading.Event()
+        self.monitor = None
+        if memory_limit:
+            self.monitor = threading.Thread(target=self.watch_memory, daemon=True)
+            self.monitor.start()
+        self.saved_environ = {
+            i: os.environ.get(i) for i in ("MAKEFLAGS", "SOMA_FORGE_MAKE_OPTIONS")
+        }
+        os.environ["MAKEFLAGS"] = f"-j{self.jobs} --jobserver-auth={auth}"
+        if self.directory:
+            # bv_maker configuration must not force a number of jobs that
+            # would disable the jobserver. This is only done with the named
+            # pipe because bv_maker starts make without inheriting the
+            # anonymous pipe file descriptors; make would then run one job
+            # at a time.
+            os.environ["SOMA_FORGE_MAKE_OPTIONS"] = ""
+
+    def watch_memory(self):
+        while not self.stop.wait(1.0):
+            used = memory_usage()
+            if used > self.memory_limit and len(self.withheld) < self.jobs - 1:
+                if select.select([self.read_fd], [], [], 0)[0]:
+                    self.withheld.append(os.read(self.read_fd, 1))
+            elif used < 0.9 * self.memory_limit and self.withheld:
+                os.write(self.write_fd, self.withheld.pop())
+
+    def close(self):
+        self.stop.set()
+        if self.monitor is not None:
+            self.monitor.join()
+        for name, value in self.saved_environ.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        os.close(self.read_fd)
+        if self.write_fd != self.read_fd:
+            os.close(self.write_fd)
+        if self.directory:
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# Directories removed with remove_directory() are first moved here
+trash_dir = pixi_root / "forge" / "bld" / "trash"
+trash_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+def remove_directory(directory):
+    """
+    Remove a directory without waiting for its content to be deleted. The
+    directory is atomically renamed in trash_dir and the content of trash_dir
+    is deleted in a background thread. Return a Future that is done when
+    deletion is finished.
+    """
+    directory = pathlib.Path(directory)
+    trash_dir.mkdir(parents=True, exist_ok=True)
+    if directory.exists():
+        os.rename(directory, trash_dir / f"{directory.name}.{uuid.uuid4().hex}")
+    return trash_executor.submit(empty_trash)
+
+
+def empty_trash():
+    """
+    Delete all directories in trash_dir, including those left by previous
+    processes.
+    """
+    if trash_dir.exists():
+        for path in trash_dir.iterdir():
+            shutil.rmtree(path, ignore_errors=True)
+
+
+# Fingerprints of packages built in local forge (see recipe_fingerprint())
+fingerprints_file = pixi_root / "forge" / "fingerprints.json"
+fingerprints_lock = threading.Lock()
+
+
+def forged_fingerprints():
+    """
+    Return a dictionary whose keys are packages names and values are the
+    fingerprints recorded when they were built in local forge.
+    """
+    if fingerprints_file.exists():
+        with open(fingerprints_file) as f:
+            return json.load(f)
+    return {}
+
+
+def record_fingerprint(package, fingerprint):
+    """
+    Record the fingerprint of a package successfully built in local forge.
+    """
+    with fingerprints_lock:
+        fingerprints = forged_fingerprints()
+        fingerprints[package] = fingerprint
+        write_atomic(
+            fingerprints_file,
+            json.dumps(fingerprints, indent=2, sort_keys=True).encode(),
+        )
 
 
 def read_pixi_config():
@@ -187,13 +1550,340 @@ def write_pixi_config(pixi_config):
         toml.dump(pixi_config, f, encoder=toml.TomlPreserveCommentEncoder())
 
 
+# Fingerprint of the inputs of the last successful setup
+setup_fingerprint_file = pixi_root / "forge" / "cache" / "setup.json"
+
+
+def setup_fingerprint(pixi_config=None):
+    """
+    Return a hash of everything setup depends on: the files of the recipes
+    directory (names, sizes and modification times), the content of
+    conf/soma-forge.yaml (that selects the recipes), the channels and
+    dependencies tables of pixi.toml, the repodata files of local forge and
+    the presence of brainvisa-cmake sources.
+    """
+    if pixi_config is None:
+        pixi_config = read_pixi_config()
+    hash = tree_digest(pixi_root / "recipes")
+    config_file = pixi_root / "conf" / "soma-forge.yaml"
+    if config_file.exists():
+        hash.update(config_file.read_bytes())
+    hash.update(b"\0")
+    hash.update(
+        json.dumps(
+            [
+                pixi_config.get("project", {}).get("channels"),
+                pixi_config.get("dependencies"),
+            ],
+            sort_keys=True,
+        ).encode()
+    )
+    for repodata_file in sorted((pixi_root / "forge").glob("*/repodata.json")):
+        stat = repodata_file.stat()
+        hash.update(
+            f"{repodata_file.parent.name}\0{stat.st_size}\0"
+            f"{stat.st_mtime_ns}\0".encode()
+        )
+    hash.update(str((pixi_root / "src" / "brainvisa-cmake").exists()).encode())
+    return hash.hexdigest()
+
+
+def read_setup_fingerprint():
+    try:
+        with open(setup_fingerprint_file) as f:
+            return json.load(f).get("fingerprint")
+    except (OSError, ValueError):
+        return None
+
+
+def write_setup_fingerprint(fingerprint):
+    setup_fingerprint_file.parent.mkdir(parents=True, exist_ok=True)
+    write_atomic(
+        setup_fingerprint_file, json.dumps({"fingerprint": fingerprint}).encode()
+    )
+
+
+def test_inputs_digest(label, commands):
+    """
+    Return a hash of the inputs of the test commands of a label: the
+    commands themselves, the files they reference (executables found in PATH
+    and existing paths given as arguments), the executables, libraries and
+    Python modules built in $CASA_BUILD, the packages installed in the
+    Conda environment (that contains the package being tested) and the
+    reference data in $BRAINVISA_TEST_REF_DATA_DIR.
+    """
+    hash = hashlib.sha256()
+    hash.update(f"{label}\0".encode())
+    for command in commands:
+        hash.update(f"{command}\0".encode())
+        try:
+            args = shlex.split(command)
+        except ValueError:
+            args = command.split()
+        for i, arg in enumerate(args):
+            path = shutil.which(arg) if i == 0 else None
+            if not path and os.path.isabs(arg):
+                path = arg
+            if path and os.path.isfile(path):
+                stat = os.stat(path)
+                hash.update(f"{path}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    # Test commands load what bv_maker built rather than only the files
+    # named in the command line
+    for build_dir in ("bin", "lib", "python"):
+        hash.update(f"{build_dir}\0".encode())
+        tree_digest(casa_build() / build_dir, hash)
+    conda_prefix = os.environ.get("CONDA_PREFIX")
+    if conda_prefix:
+        # Installation path may change for each test environment, only take
+        # packages identity into account.
+        for meta_file in sorted(pathlib.Path(conda_prefix).glob("conda-meta/*.json")):
+            with open(meta_file) as f:
+                meta = json.load(f)
+            hash.update(
+                "\0".join(
+                    str(meta.get(i)) for i in ("name", "version", "build", "sha256")
+                ).encode()
+            )
+    test_ref_data_dir = os.environ.get("BRAINVISA_TEST_REF_DATA_DIR")
+    if test_ref_data_dir:
+        tree_digest(test_ref_data_dir, hash)
+    return hash.hexdigest()
+
+
+# Name of the file where digests of successful tests inputs are stored in
+# $BRAINVISA_TEST_RUN_DATA_DIR.
+test_cache_file_name = "soma-forge-test-cache.json"
+
+
+def read_test_cache(test_run_data_dir):
+    """
+    Return a dictionary whose keys are test labels and values are the digest
+    of their inputs (see test_inputs_digest()) when they last succeeded.
+    """
+    cache_file = pathlib.Path(test_run_data_dir) / test_cache_file_name
+    if cache_file.exists():
+        with open(cache_file) as f:
+            return json.load(f)
+    return {}
+
+
+def write_test_cache(test_run_data_dir, cache):
+    """
+    Write test cache returned by read_test_cache()
+    """
+    cache_file = pathlib.Path(test_run_data_dir) / test_cache_file_name
+    write_atomic(cache_file, json.dumps(cache, indent=4, sort_keys=True).encode())
+
+
+# Option added to test commands to generate reference data instead of
+# comparing to it (see soma.test_utils).
+test_ref_option = "--test_mode=ref"
+
+# Name of the file where test-ref stores, for each test label, the sha256
+# of the reference files generated by its commands indexed by their path
+# relative to $BRAINVISA_TEST_REF_DATA_DIR.
+ref_manifest_name = "soma-forge-ref.json"
+
+# Directory of $BRAINVISA_TEST_REF_DATA_DIR where reference files content
+# is stored once, in files named after their sha256, and where new
+# reference files are generated.
+ref_store_name = ".soma-forge"
+
+
+def file_sha256(path):
+    """
+    Return the sha256 hex digest of a file content
+    """
+    hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            hash.update(chunk)
+    return hash.hexdigest()
+
+
+def output_digests(directory):
+    """
+    Return a dictionary whose keys are the paths (relative to directory) of
+    the regular files in a directory tree and values are their sha256.
+    """
+    directory = pathlib.Path(directory)
+    digests = {}
+    for root, dirs, files in os.walk(directory):
+        for file in files:
+            path = pathlib.Path(root) / file
+            if path.is_file() and not path.is_symlink():
+                digests[str(path.relative_to(directory))] = file_sha256(path)
+    return digests
+
+
+def read_ref_manifest(ref_dir):
+    """
+    Return the content of the reference data manifest: a dictionary whose
+    keys are test labels and values are dictionaries whose keys are the
+    paths of reference files and values are their sha256.
+    """
+    manifest_file = pathlib.Path(ref_dir) / ref_manifest_name
+    if manifest_file.exists():
+        with open(manifest_file) as f:
+            return json.load(f)
+    return {}
+
+
+def write_ref_manifest(ref_dir, manifest):
+    """
+    Write manifest returned by read_ref_manifest()
+    """
+    manifest_file = pathlib.Path(ref_dir) / ref_manifest_name
+    write_atomic(manifest_file, json.dumps(manifest, indent=4, sort_keys=True).encode())
+
+
+def store_ref_files(ref_dir, staging_dir):
+    """
+    Move the files generated in staging_dir to the same relative paths in
+    ref_dir. The content of each file is stored once in a read-only object
+    file named after its sha256 and reference files are hard links to these
+    objects, therefore identical files only use disk space once. Return a
+    dictionary whose keys are the relative paths of the moved files and
+    values are their sha256.
+    """
+    ref_dir = pathlib.Path(ref_dir)
+    objects_dir = ref_dir / ref_store_name / "objects"
+    digests = output_digests(staging_dir)
+    for path, digest in digests.items():
+        source = pathlib.Path(staging_dir) / path
+        object_file = objects_dir / digest[:2] / digest
+        if object_file.exists():
+            source.unlink()
+        else:
+            object_file.parent.mkdir(parents=True, exist_ok=True)
+            os.replace(source, object_file)
+            object_file.chmod(0o444)
+        target = ref_dir / path
+        # rename() does nothing if target is already a link to object_file
+        if target.exists() and os.path.samefile(target, object_file):
+            continue
+        target.parent.mkdir(parents=True, exist_ok=True)
+        tmp = target.with_name(f".{target.name}.{os.getpid()}.{threading.get_ident()}")
+        os.link(object_file, tmp)
+        os.replace(tmp, target)
+    return digests
+
+
+def prune_ref_objects(ref_dir, manifest):
+    """
+    Remove stored objects that are not referenced in manifest anymore
+    """
+    referenced = {digest for files in manifest.values() for digest in files.values()}
+    objects_dir = pathlib.Path(ref_dir) / ref_store_name / "objects"
+    if objects_dir.exists():
+        for object_file in objects_dir.glob("*/*"):
+            if object_file.name not in referenced:
+                object_file.unlink()
+
+
+def ctest_files(build_dir):
+    """
+    Iterate over CTestTestfile.cmake files read by ctest when it is run in
+    build_dir. Starting with the one in build_dir, subdirectories declared
+    with subdirs() are recursively followed.
+    """
+    stack = [pathlib.Path(build_dir)]
+    while stack:
+        ctest_file = stack.pop() / "CTestTestfile.cmake"
+        if not ctest_file.exists():
+            continue
+        yield ctest_file
+        with open(ctest_file) as f:
+            for m in re.finditer(r'^\s*subdirs\("?([^")]*)"?\)', f.read(), re.M):
+                stack.append(ctest_file.parent / m.group(1))
+
+
+def ctest_label_commands(label):
+    """
+    Run ctest to get the command lines of the tests having a given label.
+    Return the ctest command, its output and the list of test commands.
+    """
+    cmd = ["ctest", "-V", "-L", f"^{label}$"]
+    env = os.environ.copy()
+    env["BRAINVISA_TEST_REMOTE_COMMAND"] = "echo"
+    p = subprocess.Popen(
+        cmd,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        bufsize=-1,
+        universal_newlines=True,
+        env=env,
+    )
+    output, stderr = p.communicate()
+    if p.returncode != 0:
+        # We want to hide stderr unless ctest returns a nonzero exit
+        # code. In the case of test filtering where no tests are
+        # matched (e.g. with ctest_options=['-R', 'dummyfilter']), the
+        # annoying message 'No tests were found!!!' is printed to
+        # stderr by ctest, but it exits with return code 0.
+        sys.stderr.write(stderr)
+        raise RuntimeError("ctest failed with the above error")
+    o = output.split("\n")
+    # Extract the third line that follows each line containing ': Test
+    # command:'
+    commands = []
+    i = 0
+    while i < len(o):
+        line = o[i]
+        m = re.match(r"(^[^:]*): Test command: .*$", line)
+        if m:
+            prefix = f"{m.group(1)}: "
+            command = None
+            i += 1
+            while i < len(o) and o[i].startswith(prefix):
+                command = o[i][len(prefix) :]
+                i += 1
+            if command:
+                commands.append(command)
+        i += 1
+    return cmd, output, commands
+
+
+# Name of the file where get_test_commands() stores its result in the build
+# directory.
+test_commands_manifest = "soma-forge-tests.json"
+
+# Test commands already read in this process indexed by manifest file. Values
+# are (digest, tests) tuples.
+test_commands_cache = {}
+
+
 def get_test_commands(log_lines=None):
     """
     Use ctest to extract command lines to execute in order to run tests.
     This function returns a dictionary whose keys are name of a test (i.e.
     'axon', 'soma', etc.) and values are a list of commands to run to perform
-    the test.
+    the test. The result is stored in a manifest file in the build directory
+    and is reused (and kept in memory) as long as CTestTestfile.cmake files
+    are not modified.
     """
+    build_dir = pathlib.Path.cwd()
+    manifest_file = build_dir / test_commands_manifest
+    hash = hashlib.sha256()
+    for ctest_file in ctest_files(build_dir):
+        stat = ctest_file.stat()
+        hash.update(f"{ctest_file}\0{stat.st_size}\0{stat.st_mtime_ns}\0".encode())
+    digest = hash.hexdigest()
+    cached = test_commands_cache.get(manifest_file)
+    if cached and cached[0] == digest and log_lines is None:
+        return cached[1]
+    if manifest_file.exists():
+        with open(manifest_file) as f:
+            manifest = json.load(f)
+        if manifest.get("digest") == digest:
+            test_commands_cache[manifest_file] = (digest, manifest["tests"])
+            if log_lines is not None:
+                log_lines += [
+                    f"Test commands read from {manifest_file}",
+                    json.dumps(manifest["tests"], indent=4, separators=(",", ": ")),
+                ]
+            return manifest["tests"]
+
     cmd = ["ctest", "--print-labels"]
     # universal_newlines is the old name to request text-mode (text=True)
     o = subprocess.check_output(cmd, bufsize=-1, universal_newlines=True)
@@ -201,52 +1891,21 @@ def get_test_commands(log_lines=None):
     if log_lines is not None:
         log_lines += ["$ " + " ".join(shlex.quote(arg) for arg in cmd), o, "\n"]
     tests = {}
-    for label in labels:
-        cmd = ["ctest", "-V", "-L", f"^{label}$"]
-        env = os.environ.copy()
-        env["BRAINVISA_TEST_REMOTE_COMMAND"] = "echo"
-        p = subprocess.Popen(
-            cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            bufsize=-1,
-            universal_newlines=True,
-            env=env,
-        )
-        o, stderr = p.communicate()
-        if log_lines is not None:
-            log_lines += ["$ " + " ".join(shlex.quote(arg) for arg in cmd), o, "\n"]
-        if p.returncode != 0:
-            # We want to hide stderr unless ctest returns a nonzero exit
-            # code. In the case of test filtering where no tests are
-            # matched (e.g. with ctest_options=['-R', 'dummyfilter']), the
-            # annoying message 'No tests were found!!!' is printed to
-            # stderr by ctest, but it exits with return code 0.
-            sys.stderr.write(stderr)
-            raise RuntimeError("ctest failed with the above error")
-        o = o.split("\n")
-        # Extract the third line that follows each line containing ': Test
-        # command:'
-        commands = []
-        i = 0
-        while i < len(o):
-            line = o[i]
-            m = re.match(r"(^[^:]*): Test command: .*$", line)
-            if m:
-                prefix = f"{m.group(1)}: "
-                command = None
-                i += 1
-                while i < len(o) and o[i].startswith(prefix):
-                    command = o[i][len(prefix) :]
-                    i += 1
-                if command:
-                    commands.append(command)
-            i += 1
-        if commands:
-            tests[label] = commands
+    with concurrent.futures.ThreadPoolExecutor() as executor:
+        for label, (cmd, o, commands) in zip(
+            labels, executor.map(ctest_label_commands, labels)
+        ):
+            if log_lines is not None:
+                log_lines += ["$ " + " ".join(shlex.quote(arg) for arg in cmd), o, "\n"]
+            if commands:
+                tests[label] = commands
     if log_lines is not None:
         log_lines += [
             "Final test dictionary:",
             json.dumps(tests, indent=4, separators=(",", ": ")),
         ]
+    write_atomic(
+        manifest_file, json.dumps({"digest": digest, "tests": tests}, indent=4).encode()
+    )
+    test_commands_cache[manifest_file] = (digest, tests)
     return tests
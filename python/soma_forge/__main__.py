@@ -1,23 +1,174 @@
 import argparse
+import collections
+import concurrent.futures
 import fnmatch
+import json
 import os
+import pathlib
 import re
 import shutil
+import socket
+import socketserver
 import subprocess
 import sys
+import threading
+import time
+import traceback
+import xml.etree.ElementTree as ET
 
 from . import (
     selected_recipes,
     sorted_recipies,
+    recipe_dependencies,
+    recipe_graph,
+    recipe_components,
+    forge_index,
+    DirectoryWatcher,
     pixi_root,
     forged_packages,
+    forge_references,
+    index_forge,
+    forged_fingerprints,
+    recipe_fingerprint,
+    record_fingerprint,
     read_pixi_config,
     write_pixi_config,
+    setup_fingerprint,
+    read_setup_fingerprint,
+    write_setup_fingerprint,
     get_test_commands,
+    test_ref_option,
+    ref_store_name,
+    output_digests,
+    read_ref_manifest,
+    write_ref_manifest,
+    store_ref_files,
+    prune_ref_objects,
+    history_file,
+    logs_dir,
+    remove_directory,
+    setup_compiler_cache,
+    compiler_cache_stats,
+    compiler_cache_summary,
+    JobServer,
+    measured_run,
+    read_history,
+    record_history,
+    casa_build,
+    casa_src,
+    component_source_dirs,
+    build_success_file,
+    build_state,
+    build_steps,
+    read_build_state,
+    write_build_state,
+    test_inputs_digest,
+    read_test_cache,
+    write_test_cache,
 )
+from .install import install, job_slot
 
 
-def setup(verbose=None):
+class Progress:
+    """
+    Console view of running commands. On a terminal, the last output line of
+    each running command is displayed below printed messages and updated
+    in place. Otherwise, messages are printed with one line when a command
+    starts and one when it finishes (with its status and duration).
+    """
+
+    def __init__(self, file=sys.stdout):
+        self.file = file
+        self.tty = file.isatty()
+        self.lock = threading.Lock()
+        self.lines = {}
+        self.started = {}
+        self.drawn = 0
+        self.last_draw = 0.0
+
+    def _clear(self):
+        if self.drawn:
+            self.file.write(f"\x1b[{self.drawn}F\x1b[J")
+            self.drawn = 0
+
+    def _draw(self):
+        width = shutil.get_terminal_size().columns - 1
+        for name, line in self.lines.items():
+            self.file.write(f"[{name}] {line}"[:width] + "\n")
+        self.drawn = len(self.lines)
+        self.file.flush()
+        self.last_draw = time.monotonic()
+
+    def message(self, *args, file=None):
+        """
+        Print a message above the running commands view
+        """
+        with self.lock:
+            if self.tty:
+                self._clear()
+                self.file.flush()
+            print(*args, file=file or self.file, flush=True)
+            if self.tty:
+                self._draw()
+
+    def start(self, name):
+        with self.lock:
+            self.lines[name] = ""
+            self.started[name] = time.monotonic()
+            if self.tty:
+                self._clear()
+                self._draw()
+            else:
+                print(f"START {name}", file=self.file, flush=True)
+
+    def update(self, name, line):
+        if not self.tty:
+            return
+        line = line.decode(errors="replace").strip()
+        if not line:
+            return
+        with self.lock:
+            self.lines[name] = line
+            if time.monotonic() - self.last_draw > 0.2:
+                self._clear()
+                self._draw()
+
+    def finish(self, name, returncode=0):
+        with self.lock:
+            self.lines.pop(name, None)
+            duration = time.monotonic() - self.started.pop(name, time.monotonic())
+            if self.tty:
+                self._clear()
+                self._draw()
+            else:
+                status = "FAILED" if returncode else "OK"
+                print(f"{status} [{duration:.1f}s] {name}", file=self.file, flush=True)
+
+
+def print_failure(command, result, log_file, progress=None):
+    """
+    Print a failed command and the last lines of its output
+    """
+    message = progress.message if progress is not None else print
+    message(
+        "ERROR command failed:",
+        " ".join(f"'{i}'" for i in command),
+        file=sys.stderr,
+    )
+    if result.stdout:
+        message(
+            f"Last lines of {log_file}:\n{result.stdout.rstrip()}",
+            file=sys.stderr,
+        )
+
+
+def setup(verbose=None, force=False):
+    # Nothing to do if recipes and pixi dependencies did not change since
+    # last successful setup
+    fingerprint = setup_fingerprint()
+    if not force and fingerprint == read_setup_fingerprint():
+        return
+
     # Find recipes for external projects and recipes build using bv_maker
     external_recipes = []
     bv_maker_recipes = []
@@ -33,7 +184,7 @@ def setup(verbose=None):
     # Build external packages
     for recipe in external_recipes:
         package = recipe["package"]["name"]
-        if not any(forged_packages(re.escape(package))):
+        if not any(forged_packages(name=package)):
             result = forge(
                 [package], force=False, show=False, check_build=False, verbose=verbose
             )
@@ -43,9 +194,10 @@ def setup(verbose=None):
     # Add internal forge to pixi project
     channel = f"file://{pixi_root / 'forge'}"
     pixi_config = read_pixi_config()
+    pixi_config_modified = False
     if channel not in pixi_config["project"]["channels"]:
         pixi_config["project"]["channels"].append(channel)
-        write_pixi_config(pixi_config)
+        pixi_config_modified = True
 
     # Download brainvisa-cmake sources
     if not (pixi_root / "src" / "brainvisa-cmake").exists():
@@ -83,71 +235,203 @@ def setup(verbose=None):
                         existing_constraint.add(constraint)
                         dependencies[package] = existing_constraint
 
-    # Add dependencies to pixi project
-    remove = []
-    add = []
+    # Add dependencies to pixi project. Only changed entries are modified
+    # and the environment is solved once for all of them.
+    pixi_dependencies = pixi_config.setdefault("dependencies", {})
+    dependencies_modified = False
     for package, constraint in dependencies.items():
-        pixi_constraint = pixi_config.get("dependencies", {}).get(package)
+        pixi_constraint = pixi_dependencies.get(package)
         if pixi_constraint is not None:
             if pixi_constraint == "*":
                 pixi_constraint = set()
             else:
                 pixi_constraint = set(pixi_constraint.split(","))
-            if constraint == "*":
-                constraint = set()
-            if pixi_constraint != constraint:
-                remove.append(package)
-            else:
+            if pixi_constraint == constraint:
                 continue
-        if constraint:
-            add.append(f"{package} {','.join(constraint)}")
-        else:
-            add.append(f"{package} =*")
-    try:
-        if remove:
-            command = ["pixi", "remove"] + remove
-            subprocess.check_call(command)
-        if add:
-            command = ["pixi", "add"] + add
+        pixi_dependencies[package] = ",".join(sorted(constraint)) or "*"
+        dependencies_modified = True
+    if pixi_config_modified or dependencies_modified:
+        pixi_toml = pixi_root / "pixi.toml"
+        original_pixi_toml = pixi_toml.read_bytes()
+        write_pixi_config(pixi_config)
+    if dependencies_modified:
+        command = ["pixi", "install"]
+        try:
             subprocess.check_call(command)
-    except subprocess.CalledProcessError:
-        print(
-            "ERROR command failed:",
-            " ".join(f"'{i}'" for i in command),
-            file=sys.stdout,
-            flush=True,
-        )
-        return 1
+        except subprocess.CalledProcessError:
+            print(
+                "ERROR command failed:",
+                " ".join(f"'{i}'" for i in command),
+                file=sys.stdout,
+                flush=True,
+            )
+            # Restore pixi.toml, otherwise the next setup would see the new
+            # dependencies as already installed.
+            pixi_toml.write_bytes(original_pixi_toml)
+            return 1
+    write_setup_fingerprint(setup_fingerprint())
+
+
+def build(doc=True, force=False, cpus=None, memory_limit=None):
+    with JobServer(cpus or os.cpu_count(), gib_to_bytes(memory_limit)):
+        return run_bv_maker(doc, force)
+
+
+def gib_to_bytes(value):
+    """
+    Convert a memory size given in GiB on command line to bytes
+    """
+    return None if value is None else int(value * 2**30)
 
 
-def build():
-    (pixi_root / "build" / "success").unlink(missing_ok=True)
+def run_bv_maker(doc, force):
+    """
+    Run the bv_maker steps required by sources changes since last successful
+    build. Return the exit code of bv_maker if it failed.
+    """
+    previous = None if force else read_build_state()
+    build_success_file.unlink(missing_ok=True)
+    progress = Progress()
+
+    def run(steps):
+        command = ["bv_maker"] + steps
+        log_file = logs_dir / f"bv_maker-{'-'.join(steps)}.log.gz"
+        progress.start("bv_maker")
+        result, metrics = measured_run(
+            command,
+            log_file=log_file,
+            progress=lambda line: progress.update("bv_maker", line),
+        )
+        progress.finish("bv_maker", result.returncode)
+        record_history(
+            "bv_maker", " ".join(steps), metrics, returncode=result.returncode
+        )
+        return command, result, log_file
+
+    setup_compiler_cache()
+    cache_stats = compiler_cache_stats()
     # Do not take into account failure on bv_maker sources as long as
     # unstandard branches are used.
-    subprocess.call(["bv_maker", "sources"])
-    subprocess.check_call(["bv_maker", "configure", "build", "doc"])
-    with open(pixi_root / "build" / "success", "w"):
-        pass
+    run(["sources"])
+    state = build_state()
+    steps = build_steps(previous, state, doc)
+    if steps:
+        progress.message("Run bv_maker", *steps)
+        command, result, log_file = run(steps)
+        summary = compiler_cache_summary(cache_stats, compiler_cache_stats())
+        if summary:
+            progress.message(summary)
+        if result.returncode:
+            print_failure(command, result, log_file, progress)
+            return result.returncode
+    else:
+        progress.message("Nothing changed since last build")
+    state["doc"] = doc or bool(previous and previous.get("doc") and not steps)
+    write_build_state(state)
 
 
-def forge(packages, force, show, test=True, check_build=True, verbose=None):
-    if show and verbose is None:
-        verbose = True
-    if verbose is True:
-        verbose = sys.stdout
+def rattler_build_command(recipe, channels, test, keep_work_dir=False):
+    """
+    Return the rattler-build command line used to build a recipe in the
+    local forge.
+    """
+    forge = pixi_root / "forge"
+    command = [
+        "rattler-build",
+        "build",
+        "--experimental",
+        "--no-build-id",
+        "-r",
+        recipe["soma-forge"]["recipe_dir"],
+        "--output-dir",
+        str(forge),
+    ]
+    if not test:
+        command.append("--no-test")
+    if keep_work_dir:
+        command.append("--keep-build")
+    for i in channels + [f"file://{str(forge)}"]:
+        command.extend(["-c", i])
+    return command
+
+
+def build_recipe(
+    recipe,
+    channels,
+    test,
+    verbose,
+    fingerprint=None,
+    progress=None,
+    keep_work_dir=False,
+):
+    """
+    Build the package of a recipe with rattler-build and record its
+    fingerprint on success. Output of rattler-build is written in a log file
+    and displayed in progress. If keep_work_dir is True, the work directory
+    of the previous build of the package is reused and kept after the build.
+    Return the command exit code.
+    """
+    package = recipe["package"]["name"]
+    if progress is None:
+        progress = Progress()
+    if verbose:
+        progress.message(f"Build {package}", file=verbose)
+    build_dir = pixi_root / "forge" / "bld" / f"rattler-build_{package}"
+    if build_dir.exists() and not keep_work_dir:
+        remove_directory(build_dir)
+    command = rattler_build_command(recipe, channels, test, keep_work_dir)
+    log_file = logs_dir / f"{package}.log.gz"
+    with job_slot():
+        progress.start(package)
+        result, metrics = measured_run(
+            command,
+            log_file=log_file,
+            progress=lambda line: progress.update(package, line),
+        )
+        progress.finish(package, result.returncode)
+    returncode = result.returncode
+    size = None
+    if not returncode:
+        index_forge()
+        artifacts = [pathlib.Path(i["path"]) for i in forged_packages(name=package)]
+        artifacts = [i for i in artifacts if i.exists()]
+        if artifacts:
+            size = max(artifacts, key=lambda i: i.stat().st_mtime).stat().st_size
+    record_history(
+        "package", package, metrics, returncode=returncode, size=size, test=test
+    )
+    if returncode:
+        print_failure(command, result, log_file, progress)
+    elif fingerprint:
+        record_fingerprint(package, fingerprint)
+    return returncode
+
+
+def packages_to_build(packages, force, show, verbose, project):
+    """
+    Select packages to build among those matching the given names or Unix
+    shell-like patterns. A package is rebuilt if its fingerprint changed,
+    this includes changes in packages it depends on. Return a dictionary
+    of the recipes to build in dependency order and a dictionary of the
+    fingerprints of all packages. If show is True, packages to build are
+    only displayed.
+    """
     if not packages:
         packages = ["*"]
     selector = re.compile("|".join(f"(?:{fnmatch.translate(i)})" for i in packages))
-    if check_build and not (pixi_root / "build" / "success").exists():
-        build()
-    channels = read_pixi_config()["project"]["channels"]
+    to_build = {}
+    fingerprints = {}
+    recorded_fingerprints = forged_fingerprints()
     for recipe in sorted_recipies():
         package = recipe["package"]["name"]
-        recipe_dir = recipe["soma-forge"]["recipe_dir"]
+        fingerprints[package] = recipe_fingerprint(recipe, fingerprints, project)
         if selector.match(package):
             if not force:
                 # Check for the package exsitence
-                if any(forged_packages(f"^{re.escape(package)}$")):
+                if (
+                    any(forged_packages(name=package))
+                    and recorded_fingerprints.get(package) == fingerprints[package]
+                ):
                     if verbose:
                         print(
                             f"Skip existing package {package}",
@@ -155,82 +439,1100 @@ def forge(packages, force, show, test=True, check_build=True, verbose=None):
                             flush=True,
                         )
                     continue
-            if verbose:
-                print(
-                    f"Build {package}",
-                    file=verbose,
-                    flush=True,
-                )
-            if not show:
-                build_dir = pixi_root / "forge" / "bld" / f"rattler-build_{package}"
-                if build_dir.exists():
-                    shutil.rmtree(build_dir)
-                forge = pixi_root / "forge"
-                command = [
-                    "rattler-build",
-                    "build",
-                    "--experimental",
-                    "--no-build-id",
-                    "-r",
-                    recipe_dir,
-                    "--output-dir",
-                    str(forge),
-                ]
-                if not test:
-                    command.append("--no-test")
-                for i in channels + [f"file://{str(forge)}"]:
-                    command.extend(["-c", i])
-                try:
-                    subprocess.check_call(command)
-                except subprocess.CalledProcessError:
+            if show:
+                if verbose:
+                    print(
+                        f"Build {package}",
+                        file=verbose,
+                        flush=True,
+                    )
+            else:
+                to_build[package] = recipe
+    return to_build, fingerprints
+
+
+def forge(
+    packages,
+    force,
+    show,
+    test=True,
+    check_build=True,
+    verbose=None,
+    jobs=1,
+    keep_going=False,
+    keep_work_dir=False,
+    cpus=None,
+    memory_limit=None,
+):
+    if show and verbose is None:
+        verbose = True
+    if verbose is True:
+        verbose = sys.stdout
+    if check_build:
+        state = read_build_state()
+        if state is None or (state and not state.get("doc")):
+            result = build(cpus=cpus, memory_limit=memory_limit)
+            if result:
+                return result
+    project = read_pixi_config()["project"]
+    channels = project["channels"]
+    try:
+        to_build, fingerprints = packages_to_build(
+            packages, force, show, verbose, project
+        )
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr, flush=True)
+        return 1
+    if show:
+        return
+
+    # Start each package as soon as all the packages it depends on that are
+    # also selected for build are successfully built. With keep_going, a
+    # failure only prevents the build of packages depending on the failed one.
+    graph = recipe_graph()
+    progress = Progress()
+    setup_compiler_cache()
+    cache_stats = compiler_cache_stats()
+    pending = dict(to_build)
+    running = {}
+    built = []
+    failed = []
+    skipped = []
+    jobs = max(jobs, 1)
+    with JobServer(
+        cpus or os.cpu_count(), gib_to_bytes(memory_limit)
+    ), concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        while running or (pending and (keep_going or not failed)):
+            if keep_going or not failed:
+                # Start packages with the longest chain of dependent packages
+                # first
+                for package, recipe in sorted(
+                    pending.items(), key=lambda i: -i[1]["soma-forge"]["priority"]
+                ):
+                    if len(running) >= jobs:
+                        break
+                    if any(
+                        d in pending or d in running.values()
+                        for d in recipe_dependencies(recipe)
+                    ):
+                        continue
+                    del pending[package]
+                    future = executor.submit(
+                        build_recipe,
+                        recipe,
+                        channels,
+                        test,
+                        verbose,
+                        fingerprints[package],
+                        progress,
+                        keep_work_dir,
+                    )
+                    running[future] = package
+            finished, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED
+            )
+            for future in finished:
+                package = running.pop(future)
+                if future.result():
+                    failed.append(package)
+                    for dependent in graph.closure([package], reverse=True):
+                        if dependent in pending:
+                            del pending[dependent]
+                            skipped.append(dependent)
+                            if keep_going:
+                                progress.message(
+                                    f"Skip {dependent} because {package} failed",
+                                    file=sys.stderr,
+                                )
+                else:
+                    built.append(package)
+    summary = compiler_cache_summary(cache_stats, compiler_cache_stats())
+    if summary:
+        print(summary, flush=True)
+    if keep_going:
+        print("Built packages:", ", ".join(built) or "none", flush=True)
+        print("Failed packages:", ", ".join(failed) or "none", flush=True)
+        print("Skipped packages:", ", ".join(skipped) or "none", flush=True)
+    if failed:
+        return 1
+
+
+# Default address of farm coordinator: a Unix socket in local forge
+farm_default_address = str(pixi_root / "forge" / "farm.sock")
+
+
+class Farm:
+    """
+    Packages distributed by farm coordinator to workers. A package is given
+    to a worker when all the packages it depends on that are also selected
+    for build are built. A package whose build failed or whose worker was
+    lost is given again to a worker at most `retries` times.
+    """
+
+    def __init__(self, to_build, fingerprints, retries, keep_going, timeout):
+        self.pending = dict(to_build)
+        self.fingerprints = fingerprints
+        self.retries = retries
+        self.keep_going = keep_going
+        self.timeout = timeout
+        self.graph = recipe_graph()
+        self.running = {}
+        self.workers = set()
+        self.failed_on = {}
+        self.attempts = collections.Counter()
+        self.built = []
+        self.failed = []
+        self.skipped = []
+        self.condition = threading.Condition()
+
+    def finished(self):
+        return not self.running and (
+            not self.pending or (self.failed and not self.keep_going)
+        )
+
+    def next_package(self, worker):
+        """
+        Wait for a package ready to be built and return it or return None if
+        there is nothing left to build.
+        """
+        with self.condition:
+            while True:
+                if self.finished():
+                    return None
+                if self.keep_going or not self.failed:
+                    for package, recipe in sorted(
+                        self.pending.items(),
+                        key=lambda i: -i[1]["soma-forge"]["priority"],
+                    ):
+                        failed_on = self.failed_on.get(package, set())
+                        if worker in failed_on and self.workers - failed_on:
+                            # Let another worker retry this package
+                            continue
+                        if not any(
+                            d in self.pending or d in self.running
+                            for d in recipe_dependencies(recipe)
+                        ):
+                            del self.pending[package]
+                            self.running[package] = worker
+                            self.attempts[package] += 1
+                            print(f"{worker} builds {package}", flush=True)
+                            return package
+                self.condition.wait()
+
+    def connected(self, worker, connected=True):
+        with self.condition:
+            if connected:
+                self.workers.add(worker)
+            else:
+                self.workers.discard(worker)
+            self.condition.notify_all()
+
+    def done(self, package, worker, returncode, lost=False):
+        """
+        Record the result of a package build. A package is rescheduled if its
+        build failed or if its worker was lost, unless it was already tried
+        retries + 1 times.
+        """
+        with self.condition:
+            del self.running[package]
+            if not returncode:
+                print(f"{worker} built {package}", flush=True)
+                record_fingerprint(package, self.fingerprints[package])
+                self.built.append(package)
+            else:
+                reason = "lost" if lost else "failed"
+                self.failed_on.setdefault(package, set()).add(worker)
+                if self.attempts[package] <= self.retries:
                     print(
-                        "ERROR command failed:",
-                        " ".join(f"'{i}'" for i in command),
+                        f"{worker} {reason} {package}, rescheduling it",
                         file=sys.stderr,
                         flush=True,
                     )
-                    return 1
+                    self.pending[package] = self.graph.recipes[package]
+                else:
+                    print(f"{worker} {reason} {package}", file=sys.stderr, flush=True)
+                    self.failed.append(package)
+                    for dependent in self.graph.closure([package], reverse=True):
+                        if dependent in self.pending:
+                            del self.pending[dependent]
+                            self.skipped.append(dependent)
+            self.condition.notify_all()
 
 
-def test_ref():
+class FarmRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Handle the connection of a farm worker. Messages are JSON objects, one
+    per line. The worker sends {"request": "job", "worker": name} and the
+    coordinator answers either {"package": name, "heartbeat": seconds} or
+    {"done": true}. During a build, the worker sends {"request":
+    "heartbeat"} regularly and then {"request": "result", "returncode":
+    code}. If the connection is closed or nothing is received during the
+    farm timeout, the package is rescheduled.
+    """
+
+    def handle(self):
+        farm = self.server.farm
+        worker = None
+        package = None
+        self.connection.settimeout(farm.timeout)
+        try:
+            for line in self.rfile:
+                message = json.loads(line)
+                request = message.get("request")
+                if request == "job":
+                    if worker is None:
+                        worker = message.get("worker", str(self.client_address))
+                        farm.connected(worker)
+                    package = farm.next_package(worker)
+                    if package is None:
+                        answer = {"done": True}
+                    else:
+                        answer = {"package": package, "heartbeat": farm.timeout / 4}
+                    self.wfile.write(json.dumps(answer).encode() + b"\n")
+                    self.wfile.flush()
+                    if package is None:
+                        break
+                elif request == "result" and package is not None:
+                    farm.done(package, worker, message.get("returncode", 1))
+                    package = None
+        except (OSError, ValueError):
+            pass
+        finally:
+            if package is not None:
+                farm.done(package, worker, 1, lost=True)
+            if worker is not None:
+                farm.connected(worker, False)
+
+
+def farm_server(address, farm):
+    """
+    Return a threaded socket server listening on a Unix socket (if address
+    contains a /) or on a TCP host:port address.
+    """
+    if "/" in address:
+        pathlib.Path(address).unlink(missing_ok=True)
+        server = socketserver.ThreadingUnixStreamServer(address, FarmRequestHandler)
+    else:
+        host, port = address.rsplit(":", 1)
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        server = socketserver.ThreadingTCPServer((host, int(port)), FarmRequestHandler)
+    server.daemon_threads = True
+    server.farm = farm
+    return server
+
+
+def farm_serve(
+    packages,
+    address=farm_default_address,
+    force=False,
+    retries=1,
+    keep_going=False,
+    timeout=300.0,
+):
+    """
+    Run the farm coordinator: select packages to build like forge and give
+    them to farm workers until all are built.
+    """
+    project = read_pixi_config()["project"]
+    try:
+        to_build, fingerprints = packages_to_build(
+            packages, force, False, None, project
+        )
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr, flush=True)
+        return 1
+    farm = Farm(to_build, fingerprints, retries, keep_going, timeout)
+    server = farm_server(address, farm)
+    print(
+        f"Waiting for workers on {address} to build {len(to_build)} packages",
+        flush=True,
+    )
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        with farm.condition:
+            while not farm.finished():
+                farm.condition.wait()
+    finally:
+        server.shutdown()
+        server.server_close()
+        if "/" in address:
+            pathlib.Path(address).unlink(missing_ok=True)
+    print("Built packages:", ", ".join(farm.built) or "none", flush=True)
+    print("Failed packages:", ", ".join(farm.failed) or "none", flush=True)
+    print("Skipped packages:", ", ".join(farm.skipped) or "none", flush=True)
+    if farm.failed or farm.pending:
+        return 1
+
+
+def farm_connect(address, wait=10.0):
+    """
+    Connect to a farm coordinator. Retry during wait seconds if the
+    coordinator is not started yet. Return None if connection failed.
+    """
+    deadline = time.monotonic() + wait
+    while True:
+        try:
+            if "/" in address:
+                connection = socket.socket(socket.AF_UNIX)
+                try:
+                    connection.connect(address)
+                except OSError:
+                    connection.close()
+                    raise
+                return connection
+            host, port = address.rsplit(":", 1)
+            return socket.create_connection((host, int(port)))
+        except OSError:
+            if time.monotonic() > deadline:
+                return None
+            time.sleep(0.5)
+
+
+def farm_worker(address, worker, test):
+    """
+    Ask farm coordinator for packages to build until it has nothing left.
+    """
+    connection = farm_connect(address)
+    if connection is None:
+        print(f"ERROR: cannot connect to {address}", file=sys.stderr, flush=True)
+        return 1
+    channels = read_pixi_config()["project"]["channels"]
+    lock = threading.Lock()
+    with connection, connection.makefile("rwb") as stream:
+
+        def send(message):
+            with lock:
+                stream.write(json.dumps(message).encode() + b"\n")
+                stream.flush()
+
+        while True:
+            send({"request": "job", "worker": worker})
+            line = stream.readline()
+            if not line:
+                # Coordinator stopped
+                return
+            answer = json.loads(line)
+            if answer.get("done"):
+                return
+            package = answer["package"]
+            stop = threading.Event()
+
+            def heartbeat():
+                while not stop.wait(answer["heartbeat"]):
+                    try:
+                        send({"request": "heartbeat"})
+                    except OSError:
+                        return
+
+            thread = threading.Thread(target=heartbeat, daemon=True)
+            thread.start()
+            try:
+                recipe = recipe_graph().recipes.get(package)
+                if recipe is None:
+                    print(f"ERROR: no recipe for {package}", file=sys.stderr)
+                    returncode = 1
+                else:
+                    # Fingerprint is recorded by coordinator
+                    returncode = build_recipe(recipe, channels, test, None)
+            finally:
+                stop.set()
+                thread.join()
+            send({"request": "result", "returncode": returncode})
+
+
+def farm_work(
+    address=farm_default_address,
+    jobs=1,
+    test=True,
+    cpus=None,
+    memory_limit=None,
+):
+    """
+    Run a farm worker building up to `jobs` packages in parallel. Packages
+    are built with rattler-build in local forge that must be shared by all
+    workers and the coordinator.
+    """
+    name = f"{socket.gethostname()}:{os.getpid()}"
+    jobs = max(jobs, 1)
+    with JobServer(
+        cpus or os.cpu_count(), gib_to_bytes(memory_limit)
+    ), concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            executor.submit(
+                farm_worker,
+                address,
+                name if jobs == 1 else f"{name}/{i}",
+                test,
+            )
+            for i in range(jobs)
+        ]
+        if any(i.result() for i in futures):
+            return 1
+
+
+def test_ref(names=None, jobs=None):
+    """
+    Generate reference data of tests in $BRAINVISA_TEST_REF_DATA_DIR. The
+    commands of each label are run in reference mode, labels being run in
+    parallel. Reference files are deduplicated with hard links and their
+    sha256 are stored in a manifest used by test to quickly compare outputs.
+    """
     test_ref_data_dir = os.environ.get("BRAINVISA_TEST_REF_DATA_DIR")
     if not test_ref_data_dir:
         print("No value for BRAINVISA_TEST_REF_DATA_DIR", file=sys.stderr, flush=True)
         return 1
-    os.makedirs(test_ref_data_dir, exists_ok=True)
+    os.makedirs(test_ref_data_dir, exist_ok=True)
+    ref_dir = pathlib.Path(test_ref_data_dir)
+
+    test_commands = get_test_commands()
+    if not names or "all" in names:
+        names = list(test_commands)
+    for name in names:
+        if name not in test_commands:
+            print("ERROR: No test named", name, file=sys.stderr, flush=True)
+            return 1
+
+    manifest = read_ref_manifest(ref_dir)
+    staging_dir = ref_dir / ref_store_name / "staging"
+    failed = []
+    with concurrent.futures.ThreadPoolExecutor(
+        max_workers=max(jobs or len(names), 1)
+    ) as executor:
+        futures = {
+            executor.submit(
+                run_ref_commands,
+                label,
+                test_commands[label],
+                staging_dir / label,
+                "test-ref",
+            ): label
+            for label in names
+        }
+        for future in concurrent.futures.as_completed(futures):
+            label = futures[future]
+            results = future.result()
+            duration = sum(i["duration"] for i in results)
+            failure = next((i for i in results if i["returncode"]), None)
+            if failure:
+                failed.append(label)
+                print(
+                    f"FAILED [{duration:.1f}s] {label}: {failure['command']}",
+                    flush=True,
+                )
+                print(
+                    f"Last lines of {failure['log']}:\n{failure['output']}",
+                    end="",
+                    flush=True,
+                )
+                continue
+            files = store_ref_files(ref_dir, staging_dir / label)
+            # Remove reference files that are not generated anymore
+            others = {path for l, f in manifest.items() if l != label for path in f}
+            for path in manifest.get(label, {}):
+                if path not in files and path not in others:
+                    (ref_dir / path).unlink(missing_ok=True)
+            manifest[label] = files
+            print(f"OK [{duration:.1f}s] {label}: {len(files)} files", flush=True)
+    write_ref_manifest(ref_dir, manifest)
+    prune_ref_objects(ref_dir, manifest)
+    shutil.rmtree(staging_dir, ignore_errors=True)
+
+    sizes = {}
+    count = 0
+    for label, files in manifest.items():
+        for path, digest in files.items():
+            count += 1
+            if digest not in sizes:
+                object_file = ref_dir / ref_store_name / "objects" / digest[:2] / digest
+                sizes[digest] = object_file.stat().st_size
+    print(
+        f"{count} reference files, {len(sizes)} distinct contents using "
+        f"{sum(sizes.values()) / 2**20:.1f}M",
+        flush=True,
+    )
+    if failed:
+        print("ERROR: failed labels:", ", ".join(failed), file=sys.stderr, flush=True)
+        return 1
 
 
-def test(name):
+def run_ref_commands(label, commands, output_dir, kind):
+    """
+    Run the test commands of a label in reference mode, writing reference
+    data in output_dir. Stop at the first failing command. Return the list of
+    results (see run_test_command()).
+    """
+    shutil.rmtree(output_dir, ignore_errors=True)
+    output_dir.mkdir(parents=True)
+    env = os.environ.copy()
+    env["BRAINVISA_TEST_REF_DATA_DIR"] = str(output_dir)
+    results = []
+    for index, command in enumerate(commands):
+        result = run_test_command(
+            label, index, f"{command} {test_ref_option}", env=env, kind=kind
+        )
+        results.append(result)
+        if result["returncode"]:
+            break
+    return results
+
+
+def run_test_command(label, index, command, env=None, kind="test"):
+    """
+    Run a test command in a shell and return a dictionary describing the
+    result. Command output is written in a log file and the last lines are
+    kept in the result.
+    """
+    log_file = logs_dir / kind / label / f"{index}.log.gz"
+    p, metrics = measured_run(command, log_file=log_file, shell=True, env=env)
+    record_history(kind, label, metrics, command=command, returncode=p.returncode)
+    return {
+        "label": label,
+        "command": command,
+        "returncode": p.returncode,
+        "duration": metrics["wall"],
+        "output": p.stdout,
+        "log": str(log_file),
+    }
+
+
+def write_test_report(results, report):
+    """
+    Write test results in a JUnit XML file if report file name ends with
+    ".xml" or in a JSON file otherwise.
+    """
+    if report.endswith(".xml"):
+        testsuites = ET.Element("testsuites")
+        by_label = {}
+        for result in results:
+            by_label.setdefault(result["label"], []).append(result)
+        for label, label_results in by_label.items():
+            testsuite = ET.SubElement(
+                testsuites,
+                "testsuite",
+                name=label,
+                tests=str(len(label_results)),
+                failures=str(sum(1 for i in label_results if i["returncode"])),
+                time=f"{sum(i['duration'] for i in label_results):.3f}",
+            )
+            for result in label_results:
+                testcase = ET.SubElement(
+                    testsuite,
+                    "testcase",
+                    classname=label,
+                    name=result["command"],
+                    time=f"{result['duration']:.3f}",
+                )
+                if result.get("cached"):
+                    ET.SubElement(testcase, "skipped", message="cached")
+                elif result["returncode"]:
+                    failure = ET.SubElement(
+                        testcase,
+                        "failure",
+                        message=f"exit code {result['returncode']}",
+                    )
+                    failure.text = result["output"]
+                else:
+                    ET.SubElement(testcase, "system-out").text = result["output"]
+        ET.ElementTree(testsuites).write(report, encoding="utf-8", xml_declaration=True)
+    else:
+        with open(report, "w") as f:
+            json.dump(results, f, indent=4)
+
+
+def test(names, jobs=1, shard=None, report=None, cache=True, hash_compare=True):
     test_commands = get_test_commands()
-    if name is None:
+    if not names:
         print(", ".join(test_commands))
-    else:
-        test_run_data_dir = os.environ.get("BRAINVISA_TEST_RUN_DATA_DIR")
-        if not test_run_data_dir:
-            print(
-                "No value for BRAINVISA_TEST_RUN_DATA_DIR", file=sys.stderr, flush=True
-            )
-            return 1
-        os.makedirs(test_run_data_dir, exists_ok=True)
+        return
+
+    test_run_data_dir = os.environ.get("BRAINVISA_TEST_RUN_DATA_DIR")
+    if not test_run_data_dir:
+        print("No value for BRAINVISA_TEST_RUN_DATA_DIR", file=sys.stderr, flush=True)
+        return 1
+    os.makedirs(test_run_data_dir, exist_ok=True)
 
+    if "all" in names:
+        names = list(test_commands)
+    to_run = []
+    for name in names:
         commands = test_commands.get(name)
         if commands is None:
             print("ERROR: No test named", name, file=sys.stderr, flush=True)
             return 1
-        for command in commands:
-            try:
-                subprocess.check_call(command, shell=True)
-            except subprocess.CalledProcessError:
+        to_run.extend((name, index, command) for index, command in enumerate(commands))
+
+    if shard:
+        m = re.match(r"^(\d+)/(\d+)$", shard)
+        if not m or not 1 <= int(m.group(1)) <= int(m.group(2)):
+            print(
+                f"ERROR: invalid shard {shard}, expected i/n with 1 <= i <= n",
+                file=sys.stderr,
+                flush=True,
+            )
+            return 1
+        index, count = int(m.group(1)) - 1, int(m.group(2))
+        to_run = to_run[index::count]
+
+    # Skip labels whose inputs did not change since their last success
+    test_cache = read_test_cache(test_run_data_dir)
+    digests = {}
+    cached_labels = set()
+    for label in dict.fromkeys(i[0] for i in to_run):
+        digests[label] = test_inputs_digest(label, test_commands[label])
+        if cache and test_cache.get(label) == digests[label]:
+            print(f"CACHED {label}", flush=True)
+            cached_labels.add(label)
+    cached = [
+        {
+            "label": label,
+            "command": command,
+            "returncode": 0,
+            "duration": 0.0,
+            "output": "",
+            "cached": True,
+        }
+        for label, index, command in to_run
+        if label in cached_labels
+    ]
+    to_run = [i for i in to_run if i[0] not in cached_labels]
+
+    # Labels having reference files in test-ref manifest are first run in
+    # reference mode and their outputs are compared by hash to the
+    # manifest. Test commands, that do a full comparison, are only run if
+    # outputs differ.
+    test_ref_data_dir = os.environ.get("BRAINVISA_TEST_REF_DATA_DIR")
+    ref_manifest = {}
+    if hash_compare and test_ref_data_dir:
+        ref_manifest = read_ref_manifest(test_ref_data_dir)
+    counts = collections.Counter(i[0] for i in to_run)
+    hash_labels = [
+        label
+        for label, count in counts.items()
+        if ref_manifest.get(label) and count == len(test_commands[label])
+    ]
+    identical = []
+    outputs_dir = pathlib.Path(test_run_data_dir) / ref_store_name
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = {
+            executor.submit(
+                run_ref_commands,
+                label,
+                test_commands[label],
+                outputs_dir / label,
+                "test-hash",
+            ): label
+            for label in hash_labels
+        }
+        for future in concurrent.futures.as_completed(futures):
+            label = futures[future]
+            results = future.result()
+            if not any(i["returncode"] for i in results) and output_digests(
+                outputs_dir / label
+            ) == ref_manifest.get(label):
+                duration = sum(i["duration"] for i in results)
+                print(f"IDENTICAL [{duration:.1f}s] {label}", flush=True)
+                identical.extend(
+                    dict(result, command=command, hash=True)
+                    for result, command in zip(results, test_commands[label])
+                )
+            else:
+                print(
+                    f"DIFFERENT {label}: outputs differ from reference, running "
+                    "full comparison",
+                    flush=True,
+                )
+            shutil.rmtree(outputs_dir / label, ignore_errors=True)
+    shutil.rmtree(outputs_dir, ignore_errors=True)
+    identical_labels = {i["label"] for i in identical}
+    to_run = [i for i in to_run if i[0] not in identical_labels]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        futures = [
+            executor.submit(run_test_command, label, index, command)
+            for label, index, command in to_run
+        ]
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            print(
+                f"{'FAILED' if result['returncode'] else 'OK'} "
+                f"[{result['duration']:.1f}s] {result['label']}: {result['command']}",
+                flush=True,
+            )
+            if result["returncode"]:
+                print(
+                    f"Last lines of {result['log']}:\n{result['output']}",
+                    end="",
+                    flush=True,
+                )
                 print(
                     "ERROR command failed:",
-                    command,
+                    result["command"],
                     file=sys.stderr,
                     flush=True,
                 )
-                return 1
+    results = cached + identical + [future.result() for future in futures]
+
+    # Record labels whose commands were all run successfully
+    failed = {result["label"] for result in results if result["returncode"]}
+    ran = {}
+    for result in results:
+        if not result.get("cached"):
+            ran[result["label"]] = ran.get(result["label"], 0) + 1
+    for label, count in ran.items():
+        if label not in failed and count == len(test_commands[label]):
+            test_cache[label] = digests[label]
+    if ran:
+        write_test_cache(test_run_data_dir, test_cache)
+
+    if report:
+        write_test_report(results, report)
+    if any(result["returncode"] for result in results):
+        return 1
+
+
+def affected_packages(changed):
+    """
+    Return the packages affected by a set of modified paths (as returned by
+    DirectoryWatcher.read()) and whether bv_maker build must be run. A
+    modification in a recipe directory affects its package, a modification
+    in a component source tree affects the packages installing this
+    component (source directories of components are read from bv_maker
+    configuration, by default they have the name of the component) and a
+    modification in conf directory (or lost events) affects all packages.
+    Packages depending on affected packages are also affected.
+    """
+    graph = recipe_graph()
+    recipes_dir = pixi_root / "recipes"
+    conf_dir = pixi_root / "conf"
+    src = casa_src()
+    packages = set()
+    build_needed = False
+    components = {}
+    source_dirs = {}
+    for path in changed:
+        if path is None or path == conf_dir or conf_dir in path.parents:
+            return set(graph.recipes), True
+        if recipes_dir in path.parents:
+            package = path.relative_to(recipes_dir).parts[0]
+            if package in graph.recipes:
+                packages.add(package)
+        elif src in path.parents:
+            build_needed = True
+            if not components:
+                for package, recipe in graph.recipes.items():
+                    for component in recipe_components(recipe):
+                        components.setdefault(component, set()).add(package)
+                source_dirs = component_source_dirs()
+            parts = path.relative_to(src).parts[:-1]
+            for i, part in enumerate(parts):
+                for component in {part} | source_dirs.get(
+                    "/".join(parts[: i + 1]), set()
+                ):
+                    packages.update(components.get(component, ()))
+    return set(graph.closure(packages, reverse=True)), build_needed
+
+
+def watch(delay=2.0, test=True, jobs=1, cpus=None, memory_limit=None):
+    """
+    Keep recipes, local forge index and test commands in memory, wait for
+    modifications in recipes, conf and $CASA_SRC directories and rebuild and
+    retest affected packages. Bursts of modifications are gathered until
+    nothing changes during `delay` seconds.
+    """
+    directories = [pixi_root / "recipes", pixi_root / "conf", casa_src()]
+    directories = [i for i in directories if i.is_dir()]
+    with DirectoryWatcher(directories) as watcher:
+        # Fill caches
+        recipe_graph()
+        forge_index()
+        print(
+            f"Watching {len(watcher.watches)} directories in",
+            ", ".join(str(i) for i in directories),
+            flush=True,
+        )
+        try:
+            while True:
+                changed = watcher.read()
+                while True:
+                    modified = watcher.read(timeout=delay)
+                    if not modified:
+                        break
+                    changed |= modified
+                try:
+                    packages, build_needed = affected_packages(changed)
+                    if not packages and not build_needed:
+                        continue
+                    rebuild(packages, build_needed, test, jobs, cpus, memory_limit)
+                except Exception:
+                    traceback.print_exc()
+                print("Waiting for modifications", flush=True)
+        except KeyboardInterrupt:
+            return
+
+
+def rebuild(packages, build_needed, run_tests, jobs, cpus, memory_limit):
+    """
+    Run bv_maker if needed, then forge the given packages (only those whose
+    fingerprint changed are built) and run the tests of their components.
+    """
+    if build_needed:
+        result = build(doc=False, cpus=cpus, memory_limit=memory_limit)
+        if result:
+            return result
+    if packages:
+        print("Forge", ", ".join(sorted(packages)), flush=True)
+        result = forge(
+            sorted(packages),
+            force=False,
+            show=False,
+            test=run_tests,
+            check_build=False,
+            jobs=jobs,
+            keep_going=True,
+            cpus=cpus,
+            memory_limit=memory_limit,
+        )
+        if result:
+            return result
+    if run_tests and casa_build().is_dir():
+        labels = set()
+        graph = recipe_graph()
+        for package in packages:
+            labels.update(recipe_components(graph.recipes[package]))
+        cwd = os.getcwd()
+        os.chdir(casa_build())
+        try:
+            labels = sorted(labels.intersection(get_test_commands()))
+            if labels:
+                # Packages were rebuilt because of a modification, their
+                # tests must be run even if the test cache misses it.
+                return test(labels, jobs=jobs, cache=False)
+        finally:
+            os.chdir(cwd)
+
+
+def index():
+    """
+    Update local forge repodata after packages files were added or removed
+    """
+    for subdir, (added, removed) in index_forge().items():
+        for file in added:
+            print(f"+ {subdir}/{file}")
+        for file in removed:
+            print(f"- {subdir}/{file}")
+
+
+def gc(keep=2, max_size=None, dry_run=False):
+    """
+    Remove old package files from local forge. The last `keep` builds of each
+    package and the files used by the pixi project are kept. If max_size (in
+    GiB) is given, other files are then removed, least recently used first
+    (the last build of a package being removed only if needed), until the
+    forge size is within this budget. Repodata is updated afterwards.
+    """
+    forge_dir = pixi_root / "forge"
+    references = forge_references()
+    artifacts = {}
+    for package_info in forged_packages():
+        path = pathlib.Path(package_info["path"])
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            continue
+        artifacts.setdefault(package_info["name"], []).append(
+            {
+                "path": path,
+                "size": stat.st_size,
+                "built": stat.st_mtime,
+                "used": max(stat.st_atime, stat.st_mtime),
+                "referenced": str(path.relative_to(forge_dir)) in references,
+            }
+        )
+    remove = []
+    kept = []
+    for builds in artifacts.values():
+        builds.sort(key=lambda i: i["built"], reverse=True)
+        for rank, artifact in enumerate(builds):
+            artifact["last"] = rank == 0
+            if rank < keep or artifact["referenced"]:
+                kept.append(artifact)
+            else:
+                remove.append(artifact)
+    if max_size is not None:
+        budget = gib_to_bytes(max_size)
+        total = sum(i["size"] for i in kept)
+        for artifact in sorted(
+            (i for i in kept if not i["referenced"]),
+            key=lambda i: (i["last"], i["used"]),
+        ):
+            if total <= budget:
+                break
+            remove.append(artifact)
+            total -= artifact["size"]
+
+    freed = 0
+    for artifact in sorted(remove, key=lambda i: i["path"]):
+        print(
+            "would remove" if dry_run else "remove",
+            artifact["path"].relative_to(forge_dir),
+            f"({artifact['size'] / 2**20:.1f}M)",
+        )
+        if not dry_run:
+            artifact["path"].unlink(missing_ok=True)
+        freed += artifact["size"]
+    print(
+        f"{len(remove)} package files, {freed / 2**20:.1f}M",
+        "would be freed" if dry_run else "freed",
+    )
+    if remove and not dry_run:
+        index_forge()
+
+
+def report(count):
+    # Keep the last successful build of each package
+    builds = {}
+    for record in read_history("package"):
+        if not record["returncode"]:
+            builds[record["name"]] = record
+    if not builds:
+        print("No package build recorded in", history_file)
+        return
+
+    print("Slowest packages (last successful build):")
+    print(f"  {'package':<25} {'wall':>9} {'cpu':>9} {'peak RSS':>10} {'size':>10}")
+    for record in sorted(builds.values(), key=lambda i: i["wall"], reverse=True)[
+        :count
+    ]:
+        size = record.get("size")
+        size = f"{size / 2**20:.1f}M" if size is not None else "-"
+        print(
+            f"  {record['name']:<25} {record['wall']:>8.1f}s {record['cpu']:>8.1f}s "
+            f"{record['max_rss'] / 2**20:>9.1f}M {size:>10}"
+        )
+
+    # Longest chain of dependent packages using last durations
+    finish = {}
+    previous = {}
+    try:
+        recipes = list(sorted_recipies())
+    except ValueError as e:
+        print("ERROR:", e, file=sys.stderr, flush=True)
+        return 1
+    for recipe in recipes:
+        package = recipe["package"]["name"]
+        start = 0.0
+        for dependency in recipe_dependencies(recipe):
+            if dependency in finish and finish[dependency] > start:
+                start = finish[dependency]
+                previous[package] = dependency
+        record = builds.get(package)
+        finish[package] = start + (record["wall"] if record else 0.0)
+    if finish:
+        package = max(finish, key=finish.get)
+        total = finish[package]
+        path = [package]
+        while path[-1] in previous:
+            path.append(previous[path[-1]])
+        print()
+        print(f"Critical path ({total:.1f}s):")
+        for package in reversed(path):
+            record = builds.get(package)
+            duration = f"{record['wall']:.1f}s" if record else "unknown"
+            print(f"  {package} ({duration})")
+
+
+def benchmark(
+    packages=(100, 500),
+    shapes=("layered", "random"),
+    fan_in=3,
+    artifacts=5,
+    repeat=5,
+    baseline=None,
+    save=False,
+    tolerance=0.25,
+):
+    """
+    Time planning functions on synthetic projects and compare durations to
+    those stored in a baseline file. Return 1 if a duration regressed by
+    more than tolerance unless save is True, in which case durations are
+    stored as the new baseline.
+    """
+    # Imported here because the module is also run in benchmark processes
+    from . import benchmark as bench
+
+    baseline_file = pathlib.Path(baseline or bench.baseline_file)
+    reference = {}
+    if baseline_file.exists():
+        with open(baseline_file) as f:
+            reference = json.load(f)
+    results = {}
+    regressions = []
+    for shape in shapes:
+        for count in packages:
+            scenario = (
+                f"{count} packages, {shape} graph, fan-in {fan_in}, "
+                f"{artifacts} builds per package"
+            )
+            print(f"{scenario}:", flush=True)
+            print(f"  {'benchmark':<40} {'time':>9} {'baseline':>9} {'change':>8}")
+            results[scenario] = bench.run_scenario(
+                count, shape, fan_in, artifacts, repeat
+            )
+            for name, duration in results[scenario].items():
+                previous = reference.get(scenario, {}).get(name)
+                if previous:
+                    change = f"{100 * (duration - previous) / previous:+7.1f}%"
+                    previous = f"{1000 * previous:>7.1f}ms"
+                else:
+                    change = previous = "-"
+                line = (
+                    f"  {name:<40} {1000 * duration:>7.1f}ms {previous:>9} "
+                    f"{change:>8}"
+                )
+                if bench.regression(
+                    duration, reference.get(scenario, {}).get(name), tolerance
+                ):
+                    regressions.append(f"{scenario}: {name}")
+                    line += " REGRESSION"
+                print(line, flush=True)
+    if save:
+        reference.update(results)
+        baseline_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(baseline_file, "w") as f:
+            json.dump(reference, f, indent=2, sort_keys=True)
+        print("Baseline saved in", baseline_file)
+    elif regressions:
+        print(
+            f"ERROR: {len(regressions)} benchmarks are more than "
+            f"{100 * tolerance:.0f}% slower than baseline",
+            file=sys.stderr,
+            flush=True,
+        )
+        return 1
+
+
+def deps(packages, reverse, depth, cycles):
+    graph = recipe_graph()
+    if cycles:
+        for cycle in graph.cycles():
+            print(", ".join(cycle))
+        return 1 if graph.cycles() else None
+    if not packages:
+        print("ERROR: no package selected", file=sys.stderr, flush=True)
+        return 1
+    selector = re.compile("|".join(f"(?:{fnmatch.translate(i)})" for i in packages))
+    selected = [package for package in graph.recipes if selector.match(package)]
+    if not selected:
+        print("ERROR: no package matching", *packages, file=sys.stderr, flush=True)
+        return 1
+    closure = graph.closure(selected, reverse=reverse, depth=depth)
+    for package, distance in sorted(closure.items(), key=lambda i: (i[1], i[0])):
+        print(f"{'  ' * distance}{package}")
 
 
 def dot(packages, conda):
+    graph = recipe_graph()
     conda_forge = set()
     print("digraph {")
     print("  node [shape=box, color=black, style=filled]")
@@ -242,21 +1544,15 @@ def dot(packages, conda):
             print(f'  "{package}" [fillcolor="darkolivegreen2"]')
         else:
             print(f'  "{package}" [fillcolor="bisque"]')
-        for dependency in (
-            recipe["soma-forge"].get("requirements", {}).get("brainvisa-cmake", [])
-        ):
-            print(f'  "{package}" -> "{dependency}"')
-        for dependency in (
-            recipe["soma-forge"].get("requirements", {}).get("soma-forge", [])
-        ):
+        for dependency in graph.dependencies[package]:
             print(f'  "{package}" -> "{dependency}"')
         if conda:
-            for dependency in (
+            for dependency in sorted(
                 recipe["soma-forge"].get("requirements", {}).get("conda-forge", [])
             ):
                 conda_forge.add(dependency)
                 print(f'  "{package}" -> "{dependency}"')
-    for package in conda_forge:
+    for package in sorted(conda_forge):
         print(f'  "{package}" [fillcolor="aliceblue"]')
     print("}")
 
@@ -271,10 +1567,41 @@ subparsers = parser.add_subparsers(
 )
 
 parser_setup = subparsers.add_parser("setup", help="setup environment")
+parser_setup.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="update environment even if recipes and pixi.toml did not change",
+)
 parser_setup.set_defaults(func=setup)
 parser_build = subparsers.add_parser(
     "build", help="get sources, compile and build brainvisa-cmake components"
 )
+parser_build.add_argument(
+    "--no-doc",
+    dest="doc",
+    action="store_false",
+    help="do not build documentation",
+)
+parser_build.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="run all bv_maker steps even if sources did not change",
+)
+parser_build.add_argument(
+    "--cpus",
+    type=int,
+    default=None,
+    help="number of CPUs shared by all make processes (default=number of CPUs)",
+)
+parser_build.add_argument(
+    "--memory-limit",
+    type=float,
+    default=None,
+    help="reduce the number of parallel jobs when used memory is above this "
+    "value (in GiB)",
+)
 parser_build.set_defaults(func=build)
 
 parser_forge = subparsers.add_parser("forge", help="create conda packages")
@@ -291,6 +1618,39 @@ parser_forge.add_argument(
     action="store_false",
     help="do not run tests while building packages",
 )
+parser_forge.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="number of packages built in parallel (default=1)",
+)
+parser_forge.add_argument(
+    "-k",
+    "--keep-going",
+    action="store_true",
+    help="after a package build failure, continue to build packages that do "
+    "not depend on it",
+)
+parser_forge.add_argument(
+    "--keep-work-dir",
+    action="store_true",
+    help="reuse and keep the work directory of each package between builds "
+    "instead of deleting it",
+)
+parser_forge.add_argument(
+    "--cpus",
+    type=int,
+    default=None,
+    help="number of CPUs shared by all make processes (default=number of CPUs)",
+)
+parser_forge.add_argument(
+    "--memory-limit",
+    type=float,
+    default=None,
+    help="reduce the number of parallel jobs when used memory is above this "
+    "value (in GiB)",
+)
 parser_forge.add_argument(
     "-s",
     "--show",
@@ -303,16 +1663,342 @@ parser_forge.add_argument(
     nargs="*",
     help="select packages using their names or Unix shell-like patterns",
 )
+parser_farm = subparsers.add_parser(
+    "farm", help="build packages with several workers sharing local forge"
+)
+farm_subparsers = parser_farm.add_subparsers(
+    title="farm commands", dest="farm_command", required=True
+)
+parser_farm_serve = farm_subparsers.add_parser(
+    "serve", help="give packages to build to workers"
+)
+parser_farm_serve.add_argument(
+    "-a",
+    "--address",
+    default=farm_default_address,
+    help="Unix socket path or TCP host:port to listen on " "(default=forge/farm.sock)",
+)
+parser_farm_serve.add_argument(
+    "-f",
+    "--force",
+    action="store_true",
+    help="build selected packages even if they exist",
+)
+parser_farm_serve.add_argument(
+    "-r",
+    "--retries",
+    type=int,
+    default=1,
+    help="number of times a failed package or a package whose worker was "
+    "lost is given to a worker again (default=1)",
+)
+parser_farm_serve.add_argument(
+    "-k",
+    "--keep-going",
+    action="store_true",
+    help="after a package build failure, continue to build packages that do "
+    "not depend on it",
+)
+parser_farm_serve.add_argument(
+    "--timeout",
+    type=float,
+    default=300.0,
+    help="seconds without news from a worker before its package is "
+    "rescheduled (default=300)",
+)
+parser_farm_serve.add_argument(
+    "packages",
+    type=str,
+    nargs="*",
+    help="select packages using their names or Unix shell-like patterns",
+)
+parser_farm_serve.set_defaults(func=farm_serve)
+parser_farm_work = farm_subparsers.add_parser(
+    "work", help="build packages given by a coordinator"
+)
+parser_farm_work.add_argument(
+    "-a",
+    "--address",
+    default=farm_default_address,
+    help="Unix socket path or TCP host:port of the coordinator "
+    "(default=forge/farm.sock)",
+)
+parser_farm_work.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="number of packages to build in parallel (default=1)",
+)
+parser_farm_work.add_argument(
+    "--no-test",
+    dest="test",
+    action="store_false",
+    help="do not test packages",
+)
+parser_farm_work.add_argument(
+    "--cpus",
+    type=int,
+    default=None,
+    help="number of CPUs shared by all make processes (default=number of CPUs)",
+)
+parser_farm_work.add_argument(
+    "--memory-limit",
+    type=float,
+    default=None,
+    help="reduce the number of parallel jobs when used memory is above this "
+    "value (in GiB)",
+)
+parser_farm_work.set_defaults(func=farm_work)
+
+parser_install = subparsers.add_parser(
+    "install",
+    help="install brainvisa-cmake components from $CASA_BUILD to "
+    "$BRAINVISA_INSTALL_PREFIX (used in recipes build scripts)",
+)
+parser_install.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="number of components installed in parallel (default=number of CPUs)",
+)
+parser_install.add_argument(
+    "components",
+    type=str,
+    nargs="+",
+    help="names of the components to install",
+)
+parser_install.set_defaults(func=install)
+
 parser_test = subparsers.add_parser("test", help="manage brainvisa-cmake tests")
 parser_test.add_argument(
-    "name",
+    "names",
+    type=str,
+    nargs="*",
+    help="names of the tests to run ('all' runs all tests). No value just list "
+    "the possible names.",
+)
+parser_test.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="number of test commands run in parallel (default=1)",
+)
+parser_test.add_argument(
+    "--shard",
     type=str,
-    nargs="?",
     default=None,
-    help="name of the test to run. No value just list the possible names.",
+    help="only run the i-th part of the test commands split in n parts (i/n)",
+)
+parser_test.add_argument(
+    "--no-cache",
+    dest="cache",
+    action="store_false",
+    help="run tests even if their inputs did not change since their last success",
+)
+parser_test.add_argument(
+    "--report",
+    type=str,
+    default=None,
+    help="write a report of test results and durations in this file (JUnit "
+    "XML if it ends with .xml, JSON otherwise)",
+)
+parser_test.add_argument(
+    "--no-hash",
+    dest="hash_compare",
+    action="store_false",
+    help="do not compare outputs to reference files by hash first, always "
+    "run full comparison",
 )
 parser_test.set_defaults(func=test)
 
+parser_test_ref = subparsers.add_parser(
+    "test-ref", help="generate reference data of brainvisa-cmake tests"
+)
+parser_test_ref.add_argument(
+    "names",
+    type=str,
+    nargs="*",
+    help="names of the tests whose reference data is generated (default=all)",
+)
+parser_test_ref.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=None,
+    help="number of tests run in parallel (default=all)",
+)
+parser_test_ref.set_defaults(func=test_ref)
+
+parser_watch = subparsers.add_parser(
+    "watch",
+    help="wait for modifications in recipes, configuration and sources and "
+    "rebuild affected packages",
+)
+parser_watch.add_argument(
+    "--delay",
+    type=float,
+    default=2.0,
+    help="seconds without modification before starting a rebuild (default=2)",
+)
+parser_watch.add_argument(
+    "--no-test",
+    dest="test",
+    action="store_false",
+    help="do not test packages",
+)
+parser_watch.add_argument(
+    "-j",
+    "--jobs",
+    type=int,
+    default=1,
+    help="number of packages to build in parallel (default=1)",
+)
+parser_watch.add_argument(
+    "--cpus",
+    type=int,
+    default=None,
+    help="number of CPUs shared by all make processes (default=number of CPUs)",
+)
+parser_watch.add_argument(
+    "--memory-limit",
+    type=float,
+    default=None,
+    help="reduce the number of parallel jobs when used memory is above this "
+    "value (in GiB)",
+)
+parser_watch.set_defaults(func=watch)
+
+parser_index = subparsers.add_parser(
+    "index", help="update repodata of local forge channel"
+)
+parser_index.set_defaults(func=index)
+
+parser_gc = subparsers.add_parser("gc", help="remove old packages from local forge")
+parser_gc.add_argument(
+    "-n",
+    "--keep",
+    type=int,
+    default=2,
+    help="number of builds to keep for each package (default=2)",
+)
+parser_gc.add_argument(
+    "--max-size",
+    type=float,
+    default=None,
+    metavar="GIB",
+    help="remove least recently used packages until local forge is within "
+    "this size in GiB",
+)
+parser_gc.add_argument(
+    "--dry-run",
+    action="store_true",
+    help="only show package files that would be removed",
+)
+parser_gc.set_defaults(func=gc)
+
+parser_report = subparsers.add_parser(
+    "report", help="show slowest packages and critical path of recorded builds"
+)
+parser_report.add_argument(
+    "-n",
+    "--count",
+    type=int,
+    default=10,
+    help="number of slowest packages to show (default=10)",
+)
+parser_report.set_defaults(func=report)
+
+parser_benchmark = subparsers.add_parser(
+    "benchmark",
+    help="time planning functions on synthetic recipes and compare to a baseline",
+)
+parser_benchmark.add_argument(
+    "-n",
+    "--packages",
+    type=int,
+    nargs="+",
+    default=[100, 500],
+    help="numbers of recipes of synthetic projects (default=100 500)",
+)
+parser_benchmark.add_argument(
+    "--shape",
+    dest="shapes",
+    nargs="+",
+    choices=["chain", "tree", "layered", "random"],
+    default=["layered", "random"],
+    help="shapes of the dependency graph of synthetic recipes "
+    "(default=layered random)",
+)
+parser_benchmark.add_argument(
+    "--fan-in",
+    type=int,
+    default=3,
+    help="number of dependencies of each recipe, or number of children in "
+    "tree shape (default=3)",
+)
+parser_benchmark.add_argument(
+    "--artifacts",
+    type=int,
+    default=5,
+    help="number of builds of each package in synthetic forge (default=5)",
+)
+parser_benchmark.add_argument(
+    "--repeat",
+    type=int,
+    default=5,
+    help="number of runs of each benchmark, the best time is kept (default=5)",
+)
+parser_benchmark.add_argument(
+    "--baseline",
+    default=None,
+    help="file containing reference durations (default=forge/benchmark.json)",
+)
+parser_benchmark.add_argument(
+    "--save",
+    action="store_true",
+    help="store durations in baseline file instead of comparing them",
+)
+parser_benchmark.add_argument(
+    "--tolerance",
+    type=float,
+    default=0.25,
+    help="fraction of slowdown compared to baseline considered as a "
+    "regression (default=0.25)",
+)
+parser_benchmark.set_defaults(func=benchmark)
+
+parser_deps = subparsers.add_parser(
+    "deps", help="show soma-forge packages dependencies"
+)
+parser_deps.add_argument(
+    "-r",
+    "--reverse",
+    action="store_true",
+    help="show packages depending on selected packages",
+)
+parser_deps.add_argument(
+    "-d",
+    "--depth",
+    type=int,
+    default=None,
+    help="maximum distance to selected packages (default=unlimited)",
+)
+parser_deps.add_argument(
+    "--cycles",
+    action="store_true",
+    help="only show dependency cycles",
+)
+parser_deps.add_argument(
+    "packages",
+    type=str,
+    nargs="*",
+    help="select packages using their names or Unix shell-like patterns",
+)
+parser_deps.set_defaults(func=deps)
+
 parser_dot = subparsers.add_parser(
     "dot", help="create a graphviz dot file showing packages dependencies"
 )
@@ -333,4 +2019,5 @@ parser_dot.set_defaults(func=dot)
 args = parser.parse_args(sys.argv[1:])
 kwargs = vars(args).copy()
 del kwargs["func"]
+kwargs.pop("farm_command", None)
 sys.exit(args.func(**kwargs))
@@ -0,0 +1,276 @@
+"""
+Benchmark of soma-forge planning functions on synthetic projects.
+
+A synthetic project contains generated recipes/*/recipe.yaml files whose
+dependency graph has a configurable size and shape and a local forge whose
+repodata contains a configurable number of packages. Planning functions are
+timed in a separate process using the synthetic project as
+PIXI_PROJECT_ROOT, therefore no build is ever started.
+"""
+
+import json
+import os
+import pathlib
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+from . import (
+    forge_index_cache,
+    forge_subdirs,
+    forged_packages,
+    pixi_root,
+    read_recipes,
+    recipe_graph_cache,
+    selected_recipes,
+    sorted_recipies,
+    write_shards,
+    yaml_cache_file,
+)
+
+# Shapes of the dependency graph of generated recipes
+graph_shapes = ("chain", "tree", "layered", "random")
+
+# Default file containing reference durations
+baseline_file = pixi_root / "forge" / "benchmark.json"
+
+# Durations increases below this value (in seconds) are considered as noise
+# and never reported as regressions.
+min_regression = 0.005
+
+
+def dependency_graph(packages, shape, fan_in, rng):
+    """
+    Return a list whose item i is the list of indices of the packages that
+    package i depends on. Packages only depend on packages with a lower
+    index.
+      - chain: each package depends on the previous one
+      - tree: each package depends on its parent in a tree whose nodes have
+        fan_in children
+      - layered: packages are in layers of about sqrt(packages) packages and
+        each one depends on fan_in packages of the previous layer
+      - random: each package depends on up to fan_in random packages
+    """
+    dependencies = []
+    width = max(int(packages**0.5), 1)
+    for i in range(packages):
+        if i == 0:
+            dependencies.append([])
+        elif shape == "chain":
+            dependencies.append([i - 1])
+        elif shape == "tree":
+            dependencies.append([(i - 1) // max(fan_in, 1)])
+        elif shape == "layered":
+            layer = i // width
+            if layer == 0:
+                dependencies.append([])
+            else:
+                previous = range((layer - 1) * width, layer * width)
+                dependencies.append(
+                    sorted(rng.sample(previous, min(fan_in, len(previous))))
+                )
+        elif shape == "random":
+            dependencies.append(sorted(rng.sample(range(i), min(fan_in, i))))
+        else:
+            raise ValueError(f"unknown graph shape: {shape}")
+    return dependencies
+
+
+def generate_project(directory, packages, shape, fan_in, artifacts, seed=0):
+    """
+    Create a synthetic soma-forge project in directory. One recipe out of
+    three is a brainvisa-cmake recipe installing a component, the others are
+    built by a script. Local forge repodata contains `artifacts` builds of
+    each package (and as many entries for packages that have no recipe) with
+    its sharded version. A build state is written so that forge does not run
+    bv_maker.
+    """
+    rng = random.Random(seed)
+    directory = pathlib.Path(directory)
+    names = [f"package-{i:05d}" for i in range(packages)]
+    for i, dependencies in enumerate(dependency_graph(packages, shape, fan_in, rng)):
+        recipe_dir = directory / "recipes" / names[i]
+        recipe_dir.mkdir(parents=True)
+        if i % 3 == 0:
+            script = (
+                '    cd "$CASA_BUILD"\n'
+                '    export BRAINVISA_INSTALL_PREFIX="$PREFIX"\n'
+                '    python "$PIXI_PROJECT_ROOT/python/soma_forge/install.py" '
+                f"component-{i:05d}\n"
+            )
+        else:
+            script = "    make\n    make install\n"
+        run = "".join(f"    - {names[d]}\n" for d in dependencies)
+        run += "    - python >=3.9\n    - numpy\n"
+        (recipe_dir / "recipe.yaml").write_text(
+            f"package:\n"
+            f"  name: {names[i]}\n"
+            f"  version: 1.0.{i}\n\n"
+            f"build:\n"
+            f"  number: 0\n"
+            f"  script: |\n{script}\n"
+            f"requirements:\n"
+            f"  build:\n"
+            f"    - python\n"
+            f"    - cmake\n"
+            f"    - make\n"
+            f"  run:\n{run}"
+        )
+
+    (directory / "pixi.toml").write_text(
+        '[project]\nname = "soma-forge-benchmark"\nversion = "0.1.0"\n'
+        'channels = [ "conda-forge",]\nplatforms = [ "linux-64",]\n'
+    )
+    for subdir in forge_subdirs:
+        repodata = {
+            "info": {"subdir": subdir},
+            "packages": {},
+            "packages.conda": {},
+            "removed": [],
+            "repodata_version": 1,
+        }
+        if subdir == "linux-64":
+            for name in names + [f"external-{i:05d}" for i in range(packages)]:
+                for build in range(artifacts):
+                    file = f"{name}-1.0-{build}.conda"
+                    repodata["packages.conda"][file] = {
+                        "name": name,
+                        "version": "1.0",
+                        "build": str(build),
+                        "build_number": build,
+                        "depends": ["python >=3.9"],
+                        "md5": f"{rng.getrandbits(128):032x}",
+                        "sha256": f"{rng.getrandbits(256):064x}",
+                        "size": rng.randint(1 << 10, 1 << 30),
+                        "subdir": subdir,
+                    }
+        forge_subdir = directory / "forge" / subdir
+        forge_subdir.mkdir(parents=True)
+        repodata_file = forge_subdir / "repodata.json"
+        repodata_file.write_text(json.dumps(repodata, indent=2, sort_keys=True))
+        stat = repodata_file.stat()
+        write_shards(forge_subdir, repodata, [stat.st_mtime_ns, stat.st_size])
+    (directory / "build").mkdir()
+    (directory / "build" / "success").write_text(
+        json.dumps({"config": None, "components": {}, "doc": True})
+    )
+    return names
+
+
+def cpu_time():
+    """
+    Return the CPU time used by this process and its terminated children
+    """
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return time.process_time() + children.ru_utime + children.ru_stime
+
+
+def best_time(function, repeat, setup=None):
+    """
+    Return the minimum duration of repeat calls of function. If given, setup
+    is called before each call and is not timed. CPU time is measured rather
+    than wall time to be less sensitive to the load of the machine.
+    """
+    durations = []
+    for i in range(repeat):
+        if setup is not None:
+            setup()
+        start = cpu_time()
+        function()
+        durations.append(cpu_time() - start)
+    return min(durations)
+
+
+def measure(repeat):
+    """
+    Time planning functions on the project in PIXI_PROJECT_ROOT. Caches kept
+    in memory are cleared before each call so that durations are the ones of
+    a new soma_forge process (with its disk caches). Return a dictionary
+    whose keys are benchmark names and values are durations in seconds.
+    """
+
+    def clear_caches():
+        recipe_graph_cache.clear()
+        forge_index_cache.clear()
+
+    def clear_all_caches():
+        clear_caches()
+        yaml_cache_file.unlink(missing_ok=True)
+
+    names = sorted(i.name for i in (pixi_root / "recipes").iterdir() if i.is_dir())
+
+    def lookup_all():
+        for name in names:
+            list(forged_packages(name=name))
+
+    results = {
+        "read_recipes (no cache)": best_time(
+            lambda: list(read_recipes()), repeat, clear_all_caches
+        ),
+        "read_recipes": best_time(lambda: list(read_recipes()), repeat, clear_caches),
+        "selected_recipes": best_time(
+            lambda: list(selected_recipes()), repeat, clear_caches
+        ),
+        "sorted_recipies": best_time(
+            lambda: list(sorted_recipies()), repeat, clear_caches
+        ),
+        "forged_packages": best_time(
+            lambda: list(forged_packages()), repeat, clear_caches
+        ),
+        "forged_packages(name) for all recipes": best_time(
+            lookup_all, repeat, clear_caches
+        ),
+    }
+    for name, command in (
+        ("dot", ["dot"]),
+        ("forge --show", ["forge", "--show"]),
+    ):
+        results[name] = best_time(
+            lambda: subprocess.check_call(
+                [sys.executable, "-m", "soma_forge"] + command,
+                stdout=subprocess.DEVNULL,
+            ),
+            repeat,
+        )
+    return results
+
+
+def run_scenario(packages, shape, fan_in, artifacts, repeat):
+    """
+    Generate a synthetic project in a temporary directory and time planning
+    functions on it in a new process. Return the result of measure().
+    """
+    with tempfile.TemporaryDirectory(prefix="soma-forge-benchmark-") as directory:
+        generate_project(directory, packages, shape, fan_in, artifacts)
+        env = os.environ.copy()
+        env.update(
+            PIXI_PROJECT_ROOT=directory,
+            CASA_BUILD=os.path.join(directory, "build"),
+            CASA_SRC=os.path.join(directory, "src"),
+        )
+        env.pop("BRAINVISA_BVMAKER_CFG", None)
+        output = subprocess.check_output(
+            [sys.executable, "-m", "soma_forge.benchmark", str(repeat)],
+            env=env,
+            cwd=directory,
+        )
+    return json.loads(output)
+
+
+def regression(duration, reference, tolerance):
+    """
+    Return True if a duration is more than tolerance (a fraction) above a
+    reference duration.
+    """
+    return (
+        reference is not None
+        and duration > reference * (1 + tolerance)
+        and duration - reference > min_regression
+    )
+
+
+if __name__ == "__main__":
+    json.dump(measure(int(sys.argv[1])), sys.stdout)
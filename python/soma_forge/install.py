@@ -0,0 +1,193 @@
+"""
+Installation of brainvisa-cmake components from the bv_maker build directory.
+
+This module is run by the build scripts of brainvisa-cmake recipes inside
+rattler-build environments that only contain the recipe build requirements.
+It must therefore only use the standard library and must not import other
+soma_forge modules. It is run with its path rather than with `-m` to avoid
+importing soma_forge package:
+
+    python "$PIXI_PROJECT_ROOT/python/soma_forge/install.py" <components>
+
+It also contains the jobserver client functions used by soma_forge.
+"""
+
+import argparse
+import concurrent.futures
+import contextlib
+import os
+import re
+import select
+import subprocess
+import sys
+import threading
+
+
+def make_targets(build_dir):
+    """
+    Return the set of targets defined in the Makefile of a build directory
+    """
+    o = subprocess.check_output(
+        ["make", "-C", str(build_dir), "help"], bufsize=-1, universal_newlines=True
+    )
+    return {m.group(1) for m in re.finditer(r"^\.\.\. (\S+)", o, re.M)}
+
+
+def jobserver_fds():
+    """
+    Return the file descriptors of the anonymous pipe jobserver declared in
+    MAKEFLAGS. They must be passed to child processes (see pass_fds parameter
+    of subprocess.Popen).
+    """
+    m = re.search(r"--jobserver-auth=(\d+),(\d+)", os.environ.get("MAKEFLAGS", ""))
+    if m:
+        return (int(m.group(1)), int(m.group(2)))
+    return ()
+
+
+# Implicit token of the current process used by job_slot()
+implicit_job_token = threading.Semaphore(1)
+
+
+@contextlib.contextmanager
+def job_slot():
+    """
+    Context manager waiting for a job token from the jobserver declared in
+    MAKEFLAGS (if any) and giving it back on exit. The implicit token of the
+    process is used first.
+    """
+    if implicit_job_token.acquire(blocking=False):
+        try:
+            yield
+        finally:
+            implicit_job_token.release()
+        return
+    m = re.search(r"--jobserver-auth=fifo:(\S+)", os.environ.get("MAKEFLAGS", ""))
+    fds = jobserver_fds()
+    if m:
+        read_fd = write_fd = os.open(m.group(1), os.O_RDWR)
+    elif fds:
+        read_fd, write_fd = fds
+    else:
+        yield
+        return
+    token = None
+    implicit = False
+    try:
+        # Wait for either a token from the jobserver or the release of the
+        # implicit token by another thread
+        while True:
+            try:
+                if select.select([read_fd], [], [], 0.1)[0]:
+                    token = os.read(read_fd, 1)
+                    if not token:
+                        # Jobserver was closed
+                        break
+            except OSError:
+                # Jobserver file descriptors were not inherited
+                break
+            if token:
+                break
+            if implicit_job_token.acquire(blocking=False):
+                implicit = True
+                break
+        try:
+            yield
+        finally:
+            if token:
+                os.write(write_fd, token)
+            elif implicit:
+                implicit_job_token.release()
+    finally:
+        if m:
+            os.close(read_fd)
+
+
+def install_targets(build_dir, targets):
+    """
+    Run make for each target in build_dir. Return the exit code of the
+    first failing command or 0.
+    """
+    for target in targets:
+        command = ["make", "--no-print-directory", "-C", str(build_dir), target]
+        returncode = subprocess.call(command, pass_fds=jobserver_fds())
+        if returncode:
+            print(
+                "ERROR command failed:",
+                " ".join(f"'{i}'" for i in command),
+                file=sys.stderr,
+                flush=True,
+            )
+            return returncode
+    return 0
+
+
+def install_component(build_dir, targets):
+    """
+    Run make for each install target of a component in build_dir. A job
+    token is taken from the jobserver (if any) during installation. Return
+    the exit code of the first failing command or 0.
+    """
+    with job_slot():
+        return install_targets(build_dir, targets)
+
+
+def install(components, jobs=None, build_dir=None):
+    """
+    Install brainvisa-cmake components from build_dir (default=$CASA_BUILD or
+    current directory) in $BRAINVISA_INSTALL_PREFIX. For each component, the
+    install, -dev, -usrdoc and -devdoc targets that exist are run in this
+    order. Components are installed concurrently.
+    """
+    if build_dir is None:
+        build_dir = os.environ.get("CASA_BUILD", os.getcwd())
+    existing_targets = make_targets(build_dir)
+    to_install = {}
+    for component in dict.fromkeys(components):
+        if f"install-{component}" not in existing_targets:
+            print(
+                f"ERROR: no install target for component {component}",
+                file=sys.stderr,
+                flush=True,
+            )
+            return 1
+        to_install[component] = [
+            target
+            for target in (
+                f"install-{component}{suffix}"
+                for suffix in ("", "-dev", "-usrdoc", "-devdoc")
+            )
+            if target in existing_targets
+        ]
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        results = list(
+            executor.map(
+                install_component,
+                [build_dir] * len(to_install),
+                to_install.values(),
+            )
+        )
+    if any(results):
+        return 1
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="install brainvisa-cmake components from $CASA_BUILD to "
+        "$BRAINVISA_INSTALL_PREFIX"
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="number of components installed in parallel (default=number of CPU)",
+    )
+    parser.add_argument(
+        "components",
+        type=str,
+        nargs="+",
+        help="names of the components to install",
+    )
+    args = parser.parse_args()
+    sys.exit(install(args.components, args.jobs))